@@ -3,28 +3,435 @@
 """
 
 import random
+import re
 import time
+import argparse
+import hashlib
+import hmac
+import html
+import inspect
 import json
+import mmap
+import os
+import queue
+import secrets
+import signal
+import sqlite3
+import statistics
+import struct
+import sys
+import threading
+import tracemalloc
+import uuid
+import zlib
 import requests
+import urllib3
+from concurrent.futures import Future, ThreadPoolExecutor
 import telebot
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache, partial, wraps
 from loguru import logger
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 from config import TOKEN, PROXYAPI_KEY, PROXYAPI_BASE_URL
 
-# Настройка логирования
-logger.add(
-    "debug.log",
-    format="{time} - {level}: {message}",
-    level="ERROR",
-    rotation="1 week",
-    compression="zip",
-)
+try:
+    from config import ADMIN_IDS
+except ImportError:
+    ADMIN_IDS = ()
+
+try:
+    # Несколько брендированных ботов в одном процессе:
+    # [{'name': 'main', 'token': '...', 'rate_limit': 5}, ...]
+    from config import TENANTS
+except ImportError:
+    TENANTS = ()
+
+# Отсчет времени запуска для измерения холодного старта
+STARTUP_STARTED = time.perf_counter()
+
+
+def setup_logging():
+    """Настройка логирования (выполняется при запуске бота, а не при импорте)"""
+    logger.add(
+        "debug.log",
+        format="{time} - {level}: {message}",
+        level="ERROR",
+        rotation="1 week",
+        compression="zip",
+        enqueue=True,
+    )
+
+
+class Lazy:
+    """Ленивая обертка: объект создается при первом обращении к атрибуту"""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._instance = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    self._instance = self._factory()
+        return getattr(self._instance, name)
+
+# Настройки трассировки обработки апдейтов
+TRACING_ENABLED = True
+TRACE_LOG_PATH = "trace.log"
+TRACE_SAMPLE_RATE = 0.1
+# Медленные и упавшие обработки пишутся всегда, независимо от сэмплирования
+TRACE_SLOW_THRESHOLD = 5.0
+TRACE_QUEUE_SIZE = 10000
+
+
+class Tracer:
+    """Трассировка обработки апдейтов.
+
+    Trace создается при диспетчеризации апдейта, внутри него записываются
+    спаны (загрузка сессии, промпт, запрос к LLM, вызовы Bot API, разбиение
+    сообщения). Готовые записи в JSON уходят в очередь и пишутся в файл
+    фоновым потоком, поэтому обработчик не ждет диска.
+    """
+
+    def __init__(self, path=TRACE_LOG_PATH, sample_rate=TRACE_SAMPLE_RATE,
+                 slow_threshold=TRACE_SLOW_THRESHOLD, enabled=TRACING_ENABLED):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.enabled = enabled
+        self.dropped = 0
+        self._local = threading.local()
+        self._queue = queue.Queue(maxsize=TRACE_QUEUE_SIZE)
+        self._writer = None
+        self._writer_lock = threading.Lock()
+
+    def current(self):
+        """Текущий trace потока или None"""
+        return getattr(self._local, 'trace', None)
+
+    @contextmanager
+    def trace(self, name, **attrs):
+        """Корневой trace обработки одного апдейта"""
+        if not self.enabled or self.current() is not None:
+            yield None
+            return
+
+        record = {
+            'trace_id': uuid.uuid4().hex[:16],
+            'name': name,
+            'timestamp': time.time(),
+            'attrs': attrs,
+            'spans': [],
+        }
+        sampled = random.random() < self.sample_rate
+        start = time.perf_counter()
+        self._local.trace = (record, start)
+        try:
+            yield record
+        except Exception as e:
+            record['error'] = repr(e)
+            raise
+        finally:
+            self._local.trace = None
+            record['duration_ms'] = round((time.perf_counter() - start) * 1000, 2)
+            if sampled or 'error' in record or record['duration_ms'] >= self.slow_threshold * 1000:
+                self._emit(record)
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """Спан внутри текущего trace (без trace ничего не делает)"""
+        current = self.current()
+        if current is None:
+            yield attrs
+            return
+
+        record, trace_start = current
+        start = time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            span = {
+                'name': name,
+                'start_ms': round((start - trace_start) * 1000, 2),
+                'duration_ms': round((time.perf_counter() - start) * 1000, 2),
+            }
+            if attrs:
+                span['attrs'] = attrs
+            record['spans'].append(span)
+
+    def annotate(self, **attrs):
+        """Дополнительные атрибуты текущего trace"""
+        current = self.current()
+        if current is not None:
+            current[0]['attrs'].update(attrs)
+
+    def increment(self, name):
+        """Счетчик в атрибутах текущего trace"""
+        current = self.current()
+        if current is not None:
+            attrs = current[0]['attrs']
+            attrs[name] = attrs.get(name, 0) + 1
+
+    def _emit(self, record):
+        if self._writer is None:
+            with self._writer_lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._write_loop, name='trace-writer', daemon=True)
+                    self._writer.start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write_loop(self):
+        with open(self.path, 'a', encoding='utf-8') as trace_file:
+            while True:
+                record = self._queue.get()
+                trace_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+                if self._queue.empty():
+                    trace_file.flush()
+                self._queue.task_done()
+
+    def flush(self):
+        """Дожидается записи всех накопленных trace"""
+        if self._writer is not None:
+            self._queue.join()
+
+
+tracer = Tracer()
+
+
+def traced_handler(func):
+    """Оборачивает обработчик апдейта в trace"""
+    @wraps(func)
+    def wrapper(update, *args, **kwargs):
+        chat = getattr(update, 'chat', None) or getattr(update, 'from_user', None)
+        with tracer.trace(func.__name__, chat_id=getattr(chat, 'id', None), tenant=current_tenant().name):
+            return func(update, *args, **kwargs)
+    return wrapper
+
+
+# Пул соединений к Bot API, общий для всех потоков
+TELEGRAM_POOL_SIZE = 16
+# Сколько чатов помнить для пропуска повторной отправки той же клавиатуры
+KEYBOARD_MEMORY_CHATS = 50000
+
+
+class TracedTeleBot(telebot.TeleBot):
+    """TeleBot с учетом вызовов Bot API.
+
+    Каждый вызов попадает в спан трассировки и в счетчик вызовов на одно
+    взаимодействие. Reply-клавиатура, которая уже показана в чате, повторно
+    не отправляется: Telegram сохраняет ее до замены. Показанной она
+    считается только после успешной отправки; /start и "Назад" отправляют
+    ее всегда (см. forget_keyboard).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tenant = None
+        self.api_calls = 0
+        self._keyboards = OrderedDict()
+        self._keyboards_lock = threading.Lock()
+
+    def _count_call(self, method):
+        self.api_calls += 1
+        tracer.increment('telegram_calls')
+
+    def _dedupe_keyboard(self, chat_id, reply_markup):
+        """Сериализует клавиатуру и возвращает None, если она уже показана в чате"""
+        if reply_markup is None:
+            return None
+        if isinstance(reply_markup, telebot.types.JsonSerializable):
+            reply_markup = reply_markup.to_json()
+        if not reply_markup.startswith('{"keyboard"'):
+            # Inline-клавиатуры и удаление клавиатуры привязаны к сообщению
+            return reply_markup
+
+        with self._keyboards_lock:
+            if self._keyboards.get(chat_id) == reply_markup:
+                self._keyboards.move_to_end(chat_id)
+                return None
+        return reply_markup
+
+    def _remember_keyboard(self, chat_id, reply_markup):
+        """Запоминает клавиатуру, которую Telegram принял для чата"""
+        if reply_markup is None:
+            return
+        with self._keyboards_lock:
+            if reply_markup.startswith('{"remove_keyboard"'):
+                self._keyboards.pop(chat_id, None)
+            elif reply_markup.startswith('{"keyboard"'):
+                self._keyboards[chat_id] = reply_markup
+                self._keyboards.move_to_end(chat_id)
+                if len(self._keyboards) > KEYBOARD_MEMORY_CHATS:
+                    self._keyboards.popitem(last=False)
+
+    def forget_keyboard(self, chat_id):
+        """Следующая клавиатура уйдет в чат заново: пользователь мог очистить историю"""
+        with self._keyboards_lock:
+            self._keyboards.pop(chat_id, None)
+
+    def send_message(self, chat_id, text, *args, **kwargs):
+        if 'reply_markup' in kwargs:
+            kwargs['reply_markup'] = self._dedupe_keyboard(chat_id, kwargs['reply_markup'])
+        self._count_call('send_message')
+        with tracer.span('send_message'):
+            message = super().send_message(chat_id, text, *args, **kwargs)
+        self._remember_keyboard(chat_id, kwargs.get('reply_markup'))
+        return message
+
+    def delete_message(self, *args, **kwargs):
+        self._count_call('delete_message')
+        with tracer.span('delete_message'):
+            return super().delete_message(*args, **kwargs)
+
+    def edit_message_text(self, *args, **kwargs):
+        self._count_call('edit_message_text')
+        with tracer.span('edit_message_text'):
+            return super().edit_message_text(*args, **kwargs)
+
+    def answer_inline_query(self, *args, **kwargs):
+        self._count_call('answer_inline_query')
+        with tracer.span('answer_inline_query'):
+            return super().answer_inline_query(*args, **kwargs)
+
+    def process_new_updates(self, updates):
+        if update_recorder is not None:
+            update_recorder.record(updates, self.tenant.name)
+        with tenant_scope(self.tenant):
+            super().process_new_updates(updates)
+
+    def _exec_task(self, task, *args, **kwargs):
+        # Обработчики выполняются в пуле потоков бота: переносим туда арендатора
+        super()._exec_task(partial(self.tenant.run, task), *args, **kwargs)
+
+
+def setup_telegram_session():
+    """Один пул keep-alive соединений к Bot API вместо сессии на каждый поток"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=TELEGRAM_POOL_SIZE)
+    session.mount('https://', adapter)
+    telebot.apihelper.session = session
+    telebot.apihelper.SESSION_TIME_TO_LIVE = None
+
+
+class Tenant:
+    """Один бот (токен) в общем процессе.
+
+    У арендатора свои сессии пользователей, счетчики, лимиты, подписчики и
+    рассылка. Сервис генерации, кэши контента, офлайн-пакет и пулы
+    соединений общие, поэтому одинаковый контент генерируется один раз
+    для всех ботов.
+    """
+
+    def __init__(self, name, token, rate_limit=None):
+        self.name = name
+        self.bot = TracedTeleBot(token)
+        self.bot.tenant = self
+        self.user_data = {}
+        self.request_counters = Counter()
+        # Компоненты, классы которых объявлены ниже, создаются при первом обращении
+        self.chat_rate_limiter = Lazy(lambda: ChatRateLimiter(rate_limit or CHAT_RATE_LIMIT))
+        self.inflight_jobs = Lazy(lambda: InFlightJobs())
+        self.subscription_store = Lazy(lambda: SubscriptionStore(self.path(SUBSCRIPTIONS_DB_PATH)))
+        self.broadcast_engine = Lazy(lambda: BroadcastEngine(self.subscription_store, self.bot))
+
+    def path(self, base_path):
+        """Путь к файлу состояния арендатора: sessions.json -> sessions.brand.json"""
+        if self is tenants[0]:
+            return base_path
+        root, ext = os.path.splitext(base_path)
+        return f"{root}.{self.name}{ext}"
+
+    def run(self, func, *args, **kwargs):
+        """Выполнение функции от имени арендатора"""
+        with tenant_scope(self):
+            return func(*args, **kwargs)
+
+    def share_handlers(self, primary):
+        """Общие с основным ботом списки обработчиков (регистрация через bot попадает во все)"""
+        for attr, value in vars(primary.bot).items():
+            if attr.endswith('_handlers') and isinstance(value, list):
+                setattr(self.bot, attr, value)
+
+
+_tenant_context = threading.local()
+
+
+def current_tenant():
+    """Арендатор, от имени которого обрабатывается апдейт в этом потоке"""
+    return getattr(_tenant_context, 'tenant', None) or tenants[0]
+
+
+@contextmanager
+def tenant_scope(tenant):
+    """Назначение арендатора текущему потоку"""
+    previous = getattr(_tenant_context, 'tenant', None)
+    _tenant_context.tenant = tenant
+    try:
+        yield tenant
+    finally:
+        _tenant_context.tenant = previous
+
+
+class TenantScoped:
+    """Прокси на атрибут текущего арендатора (bot, user_data и т.д.)"""
+
+    def __init__(self, attr):
+        object.__setattr__(self, '_attr', attr)
+
+    def _target(self):
+        return getattr(current_tenant(), self._attr)
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._target(), name, value)
+
+    def __contains__(self, key):
+        return key in self._target()
+
+    def __getitem__(self, key):
+        return self._target()[key]
+
+    def __setitem__(self, key, value):
+        self._target()[key] = value
+
+    def __delitem__(self, key):
+        del self._target()[key]
+
+    def __iter__(self):
+        return iter(self._target())
+
+    def __len__(self):
+        return len(self._target())
+
+
+tenants = [
+    Tenant(config['name'], config['token'], config.get('rate_limit'))
+    for config in (TENANTS or [{'name': 'main', 'token': TOKEN}])
+]
+tenants_by_name = {tenant.name: tenant for tenant in tenants}
+for tenant in tenants[1:]:
+    tenant.share_handlers(tenants[0])
 
-bot = telebot.TeleBot(TOKEN)
+# Обработчики регистрируются через bot, который указывает на бота текущего арендатора
+bot = TenantScoped('bot')
 
 # user_data - словарь для хранения пользовательских данных
-user_data = {}
+user_data = TenantScoped('user_data')
 
 # Данные знаков зодиака с датами
 ZODIAC_SIGNS = {
@@ -114,32 +521,1178 @@ ZODIAC_SIGNS = {
     }
 }
 
+SIGN_IDS_BY_NAME = {sign_data['name']: sign_id for sign_id, sign_data in ZODIAC_SIGNS.items()}
+
+# Часовой пояс пользователей, для которых он не известен
+DEFAULT_TIMEZONE = 'Europe/Moscow'
+# Часовые пояса на выбор (кнопка -> пояс IANA); можно ввести и имя пояса вроде Asia/Almaty
+TIMEZONE_CHOICES = {
+    'Калининград (UTC+2)': 'Europe/Kaliningrad',
+    'Москва (UTC+3)': 'Europe/Moscow',
+    'Самара (UTC+4)': 'Europe/Samara',
+    'Екатеринбург (UTC+5)': 'Asia/Yekaterinburg',
+    'Омск (UTC+6)': 'Asia/Omsk',
+    'Новосибирск (UTC+7)': 'Asia/Novosibirsk',
+    'Иркутск (UTC+8)': 'Asia/Irkutsk',
+    'Якутск (UTC+9)': 'Asia/Yakutsk',
+    'Владивосток (UTC+10)': 'Asia/Vladivostok',
+    'Магадан (UTC+11)': 'Asia/Magadan',
+    'Камчатка (UTC+12)': 'Asia/Kamchatka',
+}
+
+MONTHS_RU = [
+    'январь', 'февраль', 'март', 'апрель', 'май', 'июнь',
+    'июль', 'август', 'сентябрь', 'октябрь', 'ноябрь', 'декабрь'
+]
+
+
+@lru_cache(maxsize=256)
+def _period_info(period, day):
+    """Границы, каноническая корзина и подпись периода для даты (мемоизировано)"""
+    if period == 'tomorrow':
+        day = day + timedelta(days=1)
+        period = 'today'
+
+    if period == 'today':
+        return day, day, day.isoformat(), f"{day.day} {MONTHS_RU[day.month-1]}"
+    if period == 'week':
+        start = day - timedelta(days=day.weekday())
+        end = start + timedelta(days=6)
+        iso_year, iso_week, _ = day.isocalendar()
+        return start, end, f"{iso_year}-W{iso_week:02d}", f"{start:%d.%m} - {end:%d.%m}"
+    if period == 'month':
+        start = day.replace(day=1)
+        end = (start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+        return start, end, f"{day:%Y-%m}", f"{MONTHS_RU[day.month-1]}"
+    if period == 'year':
+        return day.replace(month=1, day=1), day.replace(month=12, day=31), f"{day.year}", f"{day.year}"
+    return day, day, day.isoformat(), ""
+
+
+class CalendarService:
+    """Единый календарь периодов гороскопа с учетом часового пояса.
+
+    Все места, где нужна "сегодняшняя" дата (клавиатура, промпт, подпись
+    периода, ключи кэша, рассылка), берут ее отсюда, а значит согласованы
+    между собой. Корзина периода (2026-10-19, 2026-W43, 2026-10, 2026)
+    одинакова для всех пользователей с той же локальной датой.
+    """
+
+    def __init__(self, default_timezone=DEFAULT_TIMEZONE):
+        self.default_timezone = default_timezone
+        # Зафиксированная дата для воспроизведения записанного трафика
+        self.frozen_day = None
+
+    def now(self, timezone=None):
+        """Текущее время в часовом поясе пользователя"""
+        return datetime.now(ZoneInfo(timezone or self.default_timezone))
+
+    def today(self, timezone=None):
+        """Текущая дата в часовом поясе пользователя"""
+        return self.frozen_day or self.now(timezone).date()
+
+    def bounds(self, period, day=None):
+        """Первый и последний день периода"""
+        start, end, _, _ = _period_info(period, day or self.today())
+        return start, end
+
+    def bucket(self, period, day=None):
+        """Каноническая корзина периода для ключей кэша и расписания"""
+        return _period_info(period, day or self.today())[2]
+
+    def label(self, period, day=None):
+        """Подпись периода для пользователя"""
+        return _period_info(period, day or self.today())[3]
+
+
+calendar_service = CalendarService()
+
+# Сжатие хранимого контента словарем, обученным на наших же ответах
+CONTENT_DICT_PATH = 'content.dict'
+# zlib использует не больше 32 KiB словаря
+CONTENT_DICT_SIZE = 32 * 1024
+CONTENT_COMPRESSION_LEVEL = 6
+_DICT_UNIT_RE = re.compile(r'[^\n.!?]+[.!?]?\s*|\n')
+
+
+class ContentCodec:
+    """Сжатие текстов с общим словарем.
+
+    Каждая запись сжимается отдельно, поэтому чтение любой записи не
+    требует распаковки соседних. Используется zstd, если установлен
+    zstandard, иначе zlib с предустановленным словарем. Заголовки разделов
+    и устойчивые фразы живут в словаре, а не повторяются в каждой записи.
+    """
+
+    ZLIB = 'zlib'
+    ZSTD = 'zstd'
+
+    def __init__(self, dictionary=b'', name=None, level=CONTENT_COMPRESSION_LEVEL):
+        self.name = name or (self.ZSTD if zstandard is not None else self.ZLIB)
+        if self.name == self.ZSTD and zstandard is None:
+            raise RuntimeError("zstandard is required to read zstd-compressed content")
+        self.dictionary = dictionary
+        self.level = level
+        self._local = threading.local()
+        # Статистика для /stats (без блокировок, значения приблизительные)
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.decodes = 0
+        self.decode_seconds = 0.0
+
+    @classmethod
+    def load(cls, path=CONTENT_DICT_PATH):
+        """Кодек со словарем из файла; без словаря записи сжимаются по отдельности"""
+        try:
+            with open(path, 'rb') as dict_file:
+                name, _, dictionary = dict_file.read().partition(b'\n')
+            return cls(dictionary, name.decode('ascii'))
+        except (OSError, ValueError, RuntimeError) as e:
+            logger.info(f"Content dictionary not used: {str(e)}")
+            return cls()
+
+    def save(self, path=CONTENT_DICT_PATH):
+        """Сохранение словаря для кэшей контента"""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as dict_file:
+            dict_file.write(self.name.encode('ascii') + b'\n' + self.dictionary)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def train(cls, samples, size=CONTENT_DICT_SIZE):
+        """Кодек со словарем, обученным на примерах текстов"""
+        if zstandard is not None:
+            try:
+                trained = zstandard.train_dictionary(size, [sample.encode('utf-8') for sample in samples])
+                return cls(trained.as_bytes(), cls.ZSTD)
+            except zstandard.ZstdError as e:
+                logger.error(f"zstd dictionary training failed: {str(e)}")
+                return cls(b'', cls.ZSTD)
+
+        # zlib: фрагменты, которые встречаются в нескольких текстах. Самые
+        # частые ставим в конец словаря - на них получаются короткие ссылки
+        counts = Counter()
+        for sample in samples:
+            counts.update(set(_DICT_UNIT_RE.findall(sample)))
+        chosen = []
+        total = 0
+        for unit, count in counts.most_common():
+            if count < 2:
+                break
+            encoded = unit.encode('utf-8')
+            if len(encoded) < 8 or total + len(encoded) > size:
+                continue
+            chosen.append(encoded)
+            total += len(encoded)
+        return cls(b''.join(reversed(chosen)), cls.ZLIB)
+
+    def _zstd(self):
+        local = self._local
+        if not hasattr(local, 'compressor'):
+            # Объекты zstd не потокобезопасны: по паре на поток
+            dict_data = zstandard.ZstdCompressionDict(self.dictionary) if self.dictionary else None
+            local.compressor = zstandard.ZstdCompressor(level=self.level, dict_data=dict_data)
+            local.decompressor = zstandard.ZstdDecompressor(dict_data=dict_data)
+        return local
+
+    def compress(self, text):
+        """Сжатие одной записи"""
+        raw = text.encode('utf-8')
+        if self.name == self.ZSTD:
+            data = self._zstd().compressor.compress(raw)
+        else:
+            options = {'zdict': self.dictionary} if self.dictionary else {}
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS, **options)
+            data = compressor.compress(raw) + compressor.flush()
+        self.raw_bytes += len(raw)
+        self.stored_bytes += len(data)
+        return data
+
+    def decompress(self, data):
+        """Распаковка одной записи"""
+        started = time.perf_counter()
+        if self.name == self.ZSTD:
+            raw = self._zstd().decompressor.decompress(data)
+        else:
+            options = {'zdict': self.dictionary} if self.dictionary else {}
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS, **options)
+            raw = decompressor.decompress(data) + decompressor.flush()
+        self.decodes += 1
+        self.decode_seconds += time.perf_counter() - started
+        return raw.decode('utf-8')
+
+    def stats(self):
+        """Коэффициент сжатия и средняя задержка распаковки"""
+        return {
+            'codec': self.name,
+            'dictionary_bytes': len(self.dictionary),
+            'ratio': round(self.raw_bytes / self.stored_bytes, 2) if self.stored_bytes else None,
+            'decode_us': round(self.decode_seconds / self.decodes * 1e6, 1) if self.decodes else None,
+        }
+
+
+content_codec = Lazy(ContentCodec.load)
+
+# Время жизни кэша сгенерированного контента и бюджет памяти на сжатые записи:
+# чем лучше сжатие, тем больше записей помещается в тот же бюджет
+CONTENT_CACHE_TTL = 3 * 60 * 60
+CONTENT_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+
+class ContentCache:
+    """LRU-кэш сгенерированного контента.
+
+    Каждая запись получает номер поколения: при обновлении записи номер
+    меняется, и подписчики (например, кэш отрисованных сообщений) узнают,
+    что их данные устарели. Результаты хранятся сжатыми (ContentCodec), а
+    размер кэша ограничен суммарным объемом сжатых записей.
+    """
+
+    def __init__(self, ttl=CONTENT_CACHE_TTL, max_bytes=CONTENT_CACHE_MAX_BYTES, codec=content_codec):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.codec = codec
+        self.stored_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._listeners = []
+
+    def subscribe(self, listener):
+        """Подписка на обновление и удаление записей: listener(key)"""
+        self._listeners.append(listener)
+
+    def _notify(self, keys):
+        for changed_key in keys:
+            for listener in self._listeners:
+                listener(changed_key)
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            expired = entry is not None and entry[2] < time.monotonic()
+            if expired:
+                del self._entries[key]
+                self.stored_bytes -= len(entry[0])
+                entry = None
+            elif entry is not None:
+                self._entries.move_to_end(key)
+        # Просроченная запись удаляется так же, как вытесненная: подписчики
+        # сбрасывают свои производные данные
+        if expired:
+            self._notify([key])
+        return entry
+
+    def get(self, key):
+        """Результат генерации из кэша или None"""
+        entry = self._lookup(key)
+        return json.loads(self.codec.decompress(entry[0])) if entry else None
+
+    def generation(self, key):
+        """Номер поколения актуальной записи или None"""
+        entry = self._lookup(key)
+        return entry[1] if entry else None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put(self, key, result):
+        """Сохранение нового результата генерации"""
+        payload = self.codec.compress(json.dumps(result, ensure_ascii=False))
+        with self._lock:
+            self._generation += 1
+            previous = self._entries.get(key)
+            if previous is not None:
+                self.stored_bytes -= len(previous[0])
+            self._entries[key] = (payload, self._generation, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            self.stored_bytes += len(payload)
+            evicted = []
+            # Новая запись остается, даже если одна не помещается в бюджет
+            while self.stored_bytes > self.max_bytes and len(self._entries) > 1:
+                evicted_key, evicted_entry = self._entries.popitem(last=False)
+                self.stored_bytes -= len(evicted_entry[0])
+                evicted.append(evicted_key)
+
+        self._notify([key] + evicted)
+
+
+# Офлайн-пакет заранее сгенерированного контента на случай недоступности LLM
+OFFLINE_PACK_PATH = 'content.pack'
+OFFLINE_PACK_MAGIC = b'ASTROPK1'
+OFFLINE_PACK_VERSION = 2
+# Заголовок: magic, версия, число слотов индекса, кодек, длина словаря,
+# объем текстов до и после сжатия
+_PACK_HEADER = struct.Struct('<8sII4sIQQ')
+# Слот индекса: хэш ключа, смещение записи, длина ключа, длина сжатого значения
+_PACK_SLOT = struct.Struct('<QQII')
+
+
+def offline_pack_key(kind, *parts):
+    """Ключ записи офлайн-пакета"""
+    return '|'.join((kind,) + parts)
+
+
+def _pack_hash(key_bytes):
+    return int.from_bytes(hashlib.blake2b(key_bytes, digest_size=8).digest(), 'little')
+
+
+class OfflineContentPack:
+    """Офлайн-пакет контента в memory-mapped файле.
+
+    Файл состоит из заголовка, хэш-таблицы слотов с открытой адресацией,
+    словаря сжатия и области данных (ключ + сжатый текст). Открытие читает
+    только заголовок, поиск записи - O(1) обращений к отображенным
+    страницам, а сами страницы разделяются между процессами через page cache.
+    """
+
+    def __init__(self, path=OFFLINE_PACK_PATH):
+        self.path = path
+        self.codec = None
+        self._mmap = None
+        self._slot_count = 0
+        self._lock = threading.Lock()
+        self._missing = False
+
+    def _open(self):
+        with self._lock:
+            if self._mmap is not None or self._missing:
+                return
+            try:
+                with open(self.path, 'rb') as pack_file:
+                    mapped = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                logger.error(f"Offline content pack not available: {self.path}")
+                self._missing = True
+                return
+
+            magic, version, slot_count, codec_name, dict_len, raw_bytes, stored_bytes = \
+                _PACK_HEADER.unpack_from(mapped, 0)
+            try:
+                if magic != OFFLINE_PACK_MAGIC or version != OFFLINE_PACK_VERSION:
+                    raise ValueError('unsupported format')
+                dict_start = _PACK_HEADER.size + slot_count * _PACK_SLOT.size
+                self.codec = ContentCodec(mapped[dict_start:dict_start + dict_len],
+                                          codec_name.rstrip(b'\0').decode('ascii'))
+                self.codec.raw_bytes, self.codec.stored_bytes = raw_bytes, stored_bytes
+            except (ValueError, RuntimeError) as e:
+                logger.error(f"Offline content pack {self.path} is not readable: {str(e)}")
+                mapped.close()
+                self._missing = True
+                return
+
+            self._slot_count = slot_count
+            self._mmap = mapped
+
+    def get(self, key):
+        """Текст записи или None"""
+        if self._mmap is None:
+            self._open()
+            if self._mmap is None:
+                return None
+
+        key_bytes = key.encode('utf-8')
+        key_hash = _pack_hash(key_bytes)
+        mask = self._slot_count - 1
+        index = key_hash & mask
+
+        for _ in range(self._slot_count):
+            slot_hash, offset, key_len, value_len = _PACK_SLOT.unpack_from(
+                self._mmap, _PACK_HEADER.size + index * _PACK_SLOT.size
+            )
+            if offset == 0:
+                return None
+            if slot_hash == key_hash and self._mmap[offset:offset + key_len] == key_bytes:
+                start = offset + key_len
+                return self.codec.decompress(self._mmap[start:start + value_len])
+            index = (index + 1) & mask
+        return None
+
+    @staticmethod
+    def write(path, entries, codec):
+        """Запись пакета из словаря {ключ: текст} (атомарная замена файла)"""
+        slot_count = 1
+        while slot_count < len(entries) * 2:
+            slot_count *= 2
+
+        slots = [None] * slot_count
+        data = bytearray()
+        data_offset = _PACK_HEADER.size + slot_count * _PACK_SLOT.size + len(codec.dictionary)
+
+        for key, text in entries.items():
+            key_bytes = key.encode('utf-8')
+            value_bytes = codec.compress(text)
+            key_hash = _pack_hash(key_bytes)
+            index = key_hash & (slot_count - 1)
+            while slots[index] is not None:
+                index = (index + 1) & (slot_count - 1)
+            slots[index] = (key_hash, data_offset + len(data), len(key_bytes), len(value_bytes))
+            data += key_bytes + value_bytes
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as pack_file:
+            raw_bytes = sum(len(text.encode('utf-8')) for text in entries.values())
+            pack_file.write(_PACK_HEADER.pack(OFFLINE_PACK_MAGIC, OFFLINE_PACK_VERSION, slot_count,
+                                              codec.name.encode('ascii'), len(codec.dictionary),
+                                              raw_bytes, sum(slot[3] for slot in slots if slot)))
+            for slot in slots:
+                pack_file.write(_PACK_SLOT.pack(*(slot or (0, 0, 0, 0))))
+            pack_file.write(codec.dictionary)
+            pack_file.write(data)
+        os.replace(tmp_path, path)
+
+
+offline_pack = OfflineContentPack()
+
+
+# Контроль допуска к LLM: одновременные генерации и очередь ожидания
+LLM_MAX_CONCURRENCY = 8
+LLM_MAX_QUEUE = 50
+LLM_QUEUE_TIMEOUT = 20
+# Позиция в очереди сообщается ожидающему не чаще раза в столько секунд:
+# каждое сообщение - вызов Telegram в момент перегрузки
+LLM_QUEUE_POSITION_INTERVAL = 3
+# Фоновые задачи не занимают больше этой доли очереди
+LLM_BACKGROUND_QUEUE_SHARE = 0.5
+
+# Приоритеты: меньше - важнее
+PRIORITY_USER = 0
+PRIORITY_BACKGROUND = 1
+
+
+class AdmissionRejected(Exception):
+    """Запрос к LLM отклонен контролем допуска (перегрузка или истек срок ожидания)"""
+
+
+class AdmissionController:
+    """Глобальный лимит одновременных генераций с ограниченной очередью.
+
+    Ожидающие обслуживаются по приоритету, затем по порядку прихода. При
+    переполнении очереди первыми отбрасываются фоновые задачи, а ожидающий
+    может получать свою позицию в очереди через on_queue_position (не чаще
+    раза в LLM_QUEUE_POSITION_INTERVAL секунд).
+    """
+
+    def __init__(self, limit=LLM_MAX_CONCURRENCY, max_queue=LLM_MAX_QUEUE):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.active = 0
+        self.shed = 0
+        self._waiters = []
+        self._sequence = 0
+        self._condition = threading.Condition()
+
+    @property
+    def waiting(self):
+        """Сколько запросов ждет в очереди"""
+        return len(self._waiters)
+
+    def _position(self, waiter):
+        return 1 + sum(1 for other in self._waiters if other['order'] < waiter['order'])
+
+    def _grant(self):
+        """Передает освободившиеся места первым ожидающим"""
+        while self._waiters and self.active < self.limit:
+            waiter = min(self._waiters, key=lambda item: item['order'])
+            self._waiters.remove(waiter)
+            waiter['state'] = 'admitted'
+            self.active += 1
+        self._condition.notify_all()
+
+    def _enqueue(self, priority):
+        """Постановка в очередь или отказ при переполнении (под блокировкой)"""
+        background_waiting = sum(1 for waiter in self._waiters if waiter['order'][0] > PRIORITY_USER)
+        if priority > PRIORITY_USER and background_waiting >= self.max_queue * LLM_BACKGROUND_QUEUE_SHARE:
+            return None
+
+        if len(self._waiters) >= self.max_queue:
+            victim = max(self._waiters, key=lambda item: item['order'])
+            if victim['order'][0] <= priority:
+                return None
+            # Вытесняем самую неважную задачу из очереди
+            self._waiters.remove(victim)
+            victim['state'] = 'rejected'
+            self._condition.notify_all()
+
+        self._sequence += 1
+        waiter = {'order': (priority, self._sequence), 'state': 'waiting'}
+        self._waiters.append(waiter)
+        return waiter
+
+    @contextmanager
+    def admit(self, priority=PRIORITY_USER, timeout=LLM_QUEUE_TIMEOUT, on_queue_position=None):
+        """Занимает место для генерации или бросает AdmissionRejected"""
+        deadline = time.monotonic() + timeout
+        reported_position = None
+        reported_at = float('-inf')
+
+        with self._condition:
+            if self.active < self.limit and not self._waiters:
+                self.active += 1
+                waiter = None
+            else:
+                waiter = self._enqueue(priority)
+                if waiter is None:
+                    self.shed += 1
+                    raise AdmissionRejected('LLM queue is full')
+
+        while waiter is not None and waiter['state'] == 'waiting':
+            with self._condition:
+                if waiter['state'] == 'waiting':
+                    position = self._position(waiter)
+                    now = time.monotonic()
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self._waiters.remove(waiter)
+                        self.shed += 1
+                        raise AdmissionRejected('LLM queue wait timed out')
+                    if position == reported_position:
+                        self._condition.wait(remaining)
+                        continue
+                    if now < reported_at + LLM_QUEUE_POSITION_INTERVAL:
+                        # Новую позицию сообщим по истечении интервала, если место еще не дадут
+                        self._condition.wait(min(remaining, reported_at + LLM_QUEUE_POSITION_INTERVAL - now))
+                        continue
+
+            if waiter['state'] == 'waiting':
+                reported_position = position
+                reported_at = time.monotonic()
+                if on_queue_position:
+                    on_queue_position(position)
+
+        if waiter is not None and waiter['state'] == 'rejected':
+            self.shed += 1
+            raise AdmissionRejected('LLM request shed by higher priority work')
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.active -= 1
+                self._grant()
+
+
+llm_admission = AdmissionController()
+
+
+# Квота провайдера LLM в минуту (уточняется по заголовкам x-ratelimit-* ответов)
+LLM_RPM_LIMIT = 500
+LLM_TPM_LIMIT = 200000
+# Оценка токенов запроса: символов на токен для русского текста и типичный размер ответа
+LLM_CHARS_PER_TOKEN = 2.5
+LLM_EXPECTED_COMPLETION_TOKENS = 1500
+# Доля квоты, которую фоновые генерации оставляют пользовательским запросам
+LLM_QUOTA_BACKGROUND_RESERVE = 0.2
+# Повторы после 429 (если Retry-After укладывается в срок ожидания)
+LLM_RATE_LIMIT_RETRIES = 2
+LLM_DEFAULT_RETRY_AFTER = 1.0
+_RESET_PART_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+_RESET_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+def parse_reset_duration(value):
+    """Длительность из заголовка x-ratelimit-reset-* ("1s", "6m0s", "120ms") в секундах"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _RESET_PART_RE.findall(value)
+    return sum(float(number) * _RESET_UNITS[unit] for number, unit in parts) if parts else None
+
+
+def request_never_sent(error):
+    """True, если запрос не дошел до провайдера: соединение так и не установлено.
+
+    Тайм-аут чтения и обрыв после отправки сюда не относятся - провайдер
+    мог принять запрос и списать квоту.
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return (isinstance(error, requests.exceptions.ConnectionError) and
+            isinstance(reason, (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError)))
+
+
+def estimate_tokens(*texts):
+    """Грубая оценка токенов запроса вместе с ожидаемым ответом"""
+    return int(sum(len(text) for text in texts) / LLM_CHARS_PER_TOKEN) + LLM_EXPECTED_COMPLETION_TOKENS
+
+
+class QuotaScheduler:
+    """Планировщик запросов под лимиты провайдера (RPM и TPM).
+
+    Запросы и токены расходуются из двух корзин, которые пополняются
+    равномерно в течение минуты. Запрос ждет, пока квоты хватит, до
+    отправки, а не после 429. Ответы уточняют лимиты и остаток по
+    заголовкам x-ratelimit-*, а 429 с Retry-After приостанавливает всех.
+    Пользовательские запросы обслуживаются раньше фоновых, а фоновые не
+    расходуют последние LLM_QUOTA_BACKGROUND_RESERVE квоты.
+    """
+
+    def __init__(self, rpm=LLM_RPM_LIMIT, tpm=LLM_TPM_LIMIT):
+        self.limits = {'requests': rpm, 'tokens': tpm}
+        self._available = dict(self.limits)
+        # Списано под запросы, ответы на которые еще не пришли
+        self._pending = {'requests': 0, 'tokens': 0}
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._waiters = []
+        self._sequence = 0
+        self._condition = threading.Condition()
+        self.throttled = 0
+        self.rate_limited = 0
+        self.rejected = 0
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        for name, limit in self.limits.items():
+            self._available[name] = min(limit, self._available[name] + elapsed * limit / 60)
+
+    def _wait_time(self, need, priority, now):
+        """Сколько ждать, пока квоты хватит (0 - можно отправлять)"""
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        wait = 0.0
+        for name, amount in need.items():
+            limit = self.limits[name]
+            floor = limit * LLM_QUOTA_BACKGROUND_RESERVE if priority > PRIORITY_USER else 0
+            # Запрос крупнее всей квоты ждет полной корзины, а не вечно
+            missing = min(amount, limit - floor) + floor - self._available[name]
+            if missing > 0:
+                wait = max(wait, missing / (limit / 60))
+        return wait
+
+    def _acquire(self, need, priority, timeout):
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            self._sequence += 1
+            order = (priority, self._sequence)
+            self._waiters.append(order)
+            try:
+                waited = False
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    # Квоту берет только первый по приоритету ожидающий
+                    wait = self._wait_time(need, priority, now) if order == min(self._waiters) else None
+                    if wait == 0:
+                        for name, amount in need.items():
+                            self._available[name] -= amount
+                            self._pending[name] += amount
+                        if waited:
+                            self.throttled += 1
+                        return
+                    remaining = deadline - now
+                    if remaining <= 0 or (wait is not None and wait > remaining):
+                        self.rejected += 1
+                        raise AdmissionRejected('LLM provider quota exhausted')
+                    waited = True
+                    self._condition.wait(wait if wait is not None else remaining)
+            finally:
+                self._waiters.remove(order)
+                self._condition.notify_all()
+
+    def _complete(self, need, response, sent):
+        """Учет ответа: лимиты и остаток из заголовков, фактические токены, 429"""
+        headers = response.headers if response is not None else {}
+        usage = None
+        if response is not None and response.status_code == 200 and 'x-ratelimit-remaining-tokens' not in headers:
+            try:
+                usage = response.json().get('usage', {}).get('total_tokens')
+            except ValueError:
+                pass
+
+        with self._condition:
+            now = time.monotonic()
+            self._refill(now)
+            for name, amount in need.items():
+                self._pending[name] -= amount
+                if not sent:
+                    # Запрос не ушел (отказ контроля допуска, соединение не установлено): квота возвращается
+                    self._available[name] = min(self.limits[name], self._available[name] + amount)
+            for name in self.limits:
+                try:
+                    if headers.get(f'x-ratelimit-limit-{name}'):
+                        self.limits[name] = int(headers[f'x-ratelimit-limit-{name}'])
+                    if headers.get(f'x-ratelimit-remaining-{name}'):
+                        remaining = int(headers[f'x-ratelimit-remaining-{name}'])
+                        self._available[name] = remaining - self._pending[name]
+                except ValueError:
+                    pass
+            if usage:
+                # Оценка разошлась с фактом: возвращаем или досписываем разницу
+                self._available['tokens'] -= usage - need['tokens']
+
+            if response is not None and response.status_code == 429:
+                self.rate_limited += 1
+                retry_after = parse_reset_duration(headers.get('retry-after')) or max(
+                    parse_reset_duration(headers.get('x-ratelimit-reset-requests')) or 0,
+                    parse_reset_duration(headers.get('x-ratelimit-reset-tokens')) or 0,
+                ) or LLM_DEFAULT_RETRY_AFTER
+                self._blocked_until = max(self._blocked_until, now + retry_after)
+            self._condition.notify_all()
+
+    @contextmanager
+    def reserve(self, tokens, priority=PRIORITY_USER, timeout=LLM_QUEUE_TIMEOUT):
+        """Резерв квоты на один запрос.
+
+        В словарь-резерв кладутся отметка отправки ('sent') и ответ
+        ('response'). Квота возвращается, только если запрос не был отправлен.
+        """
+        need = {'requests': 1, 'tokens': tokens}
+        self._acquire(need, priority, timeout)
+        reservation = {'sent': False}
+        try:
+            yield reservation
+        finally:
+            self._complete(need, reservation.get('response'), reservation['sent'])
+
+    def snapshot(self):
+        """Текущий остаток квоты для /stats"""
+        with self._condition:
+            self._refill(time.monotonic())
+            return {name: (int(self._available[name]), limit) for name, limit in self.limits.items()}
+
+
+llm_quota = QuotaScheduler()
+
+
+# Журнал ответов LLM: запись в production и детерминированное воспроизведение без сети
+LLM_JOURNAL_MODE = 'off'
+LLM_JOURNAL_PATH = 'llm_journal.jsonl'
+# Множитель записанных задержек при воспроизведении (0 - отвечать сразу)
+LLM_JOURNAL_LATENCY_SCALE = 1.0
+
+
+class LLMJournal:
+    """Журнал запросов к LLM в JSONL, файл только дописывается.
+
+    Ключ записи - хэш модели, системного и пользовательского промпта. В
+    режиме record сохраняется итоговый ответ на каждый запрос (после
+    повторов на 429) вместе с задержкой и токенами.
+    В режиме replay ответы отдаются из журнала без сети с исходной или
+    масштабированной задержкой; на запрос, которого нет в журнале,
+    возвращается 503, и генерация уходит в резервный текст.
+    """
+
+    MODES = ('off', 'record', 'replay')
+
+    def __init__(self, path=LLM_JOURNAL_PATH, mode=LLM_JOURNAL_MODE, latency_scale=LLM_JOURNAL_LATENCY_SCALE):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown LLM journal mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self.hits = 0
+        self.misses = 0
+        self._file = None
+        self._entries = None
+        self._cursors = Counter()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model, system_prompt, prompt):
+        """Ключ запроса в журнале"""
+        digest = hashlib.blake2b(digest_size=16)
+        for part in (model, system_prompt, prompt):
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def record(self, key, model, response, latency):
+        """Дописывает ответ в журнал"""
+        try:
+            body = response.json()
+        except ValueError:
+            body = response.text
+        entry = {
+            'key': key,
+            'model': model,
+            'day': calendar_service.today().isoformat(),
+            'status': response.status_code,
+            'latency': round(latency, 3),
+            'usage': body.get('usage') if isinstance(body, dict) else None,
+            'body': body,
+        }
+        line = json.dumps(entry, ensure_ascii=False)
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def _load(self):
+        with self._lock:
+            if self._entries is None:
+                self._entries = {}
+                with open(self.path, encoding='utf-8') as journal_file:
+                    for line in journal_file:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # Оборванная последняя строка после аварийной остановки
+                            logger.error(f"Skipping damaged LLM journal line in {self.path}")
+                            continue
+                        self._entries.setdefault(entry['key'], []).append(entry)
+            return self._entries
+
+    def recorded_day(self):
+        """Самая частая дата записи: на нее нужно зафиксировать календарь при воспроизведении"""
+        days = Counter(entry['day'] for entries in self._load().values() for entry in entries)
+        return date.fromisoformat(days.most_common(1)[0][0]) if days else None
+
+    def replay(self, key):
+        """Записанный ответ (повторы одного ключа отдаются по кругу) или 503"""
+        entries = self._load()
+        with self._lock:
+            recorded = entries.get(key)
+            if recorded:
+                entry = recorded[self._cursors[key] % len(recorded)]
+                self._cursors[key] += 1
+                self.hits += 1
+            else:
+                entry = None
+                self.misses += 1
+
+        if entry is None:
+            return _StubResponse({'error': 'request is not in the LLM journal'}, status_code=503)
+        time.sleep(entry['latency'] * self.latency_scale)
+        return _StubResponse(entry['body'], entry['status'])
+
+
+llm_journal = LLMJournal()
+
+
+# Проверка и исправление HTML из ответов модели перед отправкой в Telegram
+TELEGRAM_HTML_TAGS = frozenset({
+    'b', 'strong', 'i', 'em', 'u', 'ins', 's', 'strike', 'del', 'code', 'pre', 'blockquote', 'tg-spoiler',
+    'a', 'span',
+})
+# Теги, внутри которых markdown остается текстом
+_HTML_LITERAL_TAGS = frozenset({'pre', 'code'})
+# Ссылки, которые принимает Telegram
+_HTML_LINK_RE = re.compile(r'(?:https?|tg)://\S+$', re.IGNORECASE)
+_HTML_ATTR_RE = re.compile(r'([a-zA-Z-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'>]+))')
+# Заголовки HTML модель иногда выдает вместо <b>
+_HTML_HEADING_TAGS = frozenset({'h1', 'h2', 'h3', 'h4', 'h5', 'h6'})
+_HTML_BREAK_TAGS = frozenset({'br', 'p', 'div', 'ul', 'ol'})
+# Заголовки разделов, которые промпты требуют в ответе
+EXPECTED_SECTIONS = {
+    'horoscope': ('ОБЩИЙ ПРОГНОЗ', 'ЛИЧНАЯ ЖИЗНЬ', 'КАРЬЕРА', 'ЗДОРОВЬЕ', 'ЛИЧНОСТНЫЙ РОСТ',
+                  'ПРАКТИЧЕСКИЕ РЕКОМЕНДАЦИИ'),
+    'compatibility': ('ОБЩАЯ СОВМЕСТИМОСТЬ', 'РОМАНТИЧЕСКАЯ', 'ЭМОЦИОНАЛЬНАЯ', 'ПРАКТИЧЕСКАЯ СОВМЕСТИМОСТЬ',
+                      'СИЛЬНЫЕ СТОРОНЫ', 'ВОЗМОЖНЫЕ СЛОЖНОСТИ', 'РЕКОМЕНДАЦИИ ДЛЯ ПАРЫ'),
+    'name_meaning': ('ПРОИСХОЖДЕНИЕ', 'ЧЕРТЫ ХАРАКТЕРА', 'ЭНЕРГЕТИКА', 'ЛИЧНАЯ ЖИЗНЬ', 'ПРОФЕССИОНАЛЬНЫЕ',
+                     'СИЛЬНЫЕ И СЛАБЫЕ', 'СОВЕТЫ'),
+}
+# Без скольких разделов ответ еще можно отправить (но не кэшировать)
+LLM_MAX_MISSING_SECTIONS = 2
+# Сколько раз перегенерировать ответ, в котором не хватает разделов
+LLM_REGENERATE_ATTEMPTS = 1
+
+# Один проход по всем конструкциям, которые нужно сохранить или исправить. Каждая
+# альтернатива начинается с одного из символов <&*_\n: опережающая проверка по ним
+# быстро пропускает обычный текст. Markdown-заголовки и пункты ищутся после перевода строки
+_LLM_MARKUP_RE = re.compile(
+    r'(?=[<&*_\n])'
+    r'(?:(?P<tag><(?P<closing>/?)(?P<name>[a-zA-Z][a-zA-Z0-9-]*)(?P<attrs>[^<>]*)>)'
+    r'|(?P<entity>&(?:lt|gt|amp|quot|#\d{1,7}|#x[0-9a-fA-F]{1,6});)'
+    r'|(?P<bold>\*\*|__)'
+    r'|(?P<newline>\n)(?:(?P<heading>[ \t]*#{1,6}[ \t]+)|(?P<bullet>[ \t]*[*-][ \t]+))?'
+    r'|(?P<special>[<&]))'
+)
+_BOLD_SPAN_RE = re.compile(r'<b>(.*?)</b>', re.DOTALL)
+_HTML_ESCAPES = {'<': '&lt;', '&': '&amp;'}
+
+validation_counters = Counter()
+_validation_counters_lock = threading.Lock()
+
+
+def _opening_html_tag(name, attrs):
+    """Открывающий тег только с атрибутами, которые понимает Telegram.
+
+    У ссылки остается href, у span - класс tg-spoiler; ссылка без
+    допустимого адреса и span без спойлера не нужны (None).
+    """
+    values = {match.group(1).lower(): html.unescape(match.group(2) or match.group(3) or match.group(4) or '')
+              for match in _HTML_ATTR_RE.finditer(attrs)}
+    if name == 'a':
+        href = values.get('href', '').strip()
+        return f'<a href="{html.escape(href)}">' if _HTML_LINK_RE.match(href) else None
+    if name == 'span':
+        return '<span class="tg-spoiler">' if 'tg-spoiler' in values.get('class', '').split() else None
+    return f'<{name}>'
+
+
+def _close_html_tag(out, stack, name, openings=None):
+    """Закрывает тег с учетом вложенности. Возвращает число исправлений"""
+    if name not in stack:
+        # Лишний закрывающий тег отбрасываем
+        return 1
+    reopen = []
+    while stack[-1] != name:
+        inner = stack.pop()
+        out.append(f'</{inner}>')
+        reopen.append(inner)
+    stack.pop()
+    out.append(f'</{name}>')
+    for inner in reversed(reopen):
+        out.append((openings or {}).get(inner, f'<{inner}>'))
+        stack.append(inner)
+    return len(reopen)
+
+
+def _line_end(text, position):
+    """Конец строки, в которой находится position"""
+    end = text.find('\n', position)
+    return len(text) if end == -1 else end
+
+
+def sanitize_llm_html(text):
+    """Приводит ответ модели к HTML, который примет Telegram, за один проход.
+
+    Markdown (**жирный**, # заголовок, * пункт) становится HTML, неизвестные
+    теги убираются, одиночные < и & экранируются, теги закрываются в
+    правильном порядке. Жирный из markdown не выходит за конец строки, а
+    внутри заголовка (## **ОБЩИЙ ПРОГНОЗ**) маркеры жирного поглощаются.
+    Внутри <pre> и <code> markdown не разбирается. Возвращает текст и число
+    исправлений.
+    """
+    out = []
+    stack = []
+    # Открывающие теги с атрибутами для повторного открытия при неправильной вложенности
+    openings = {}
+    repairs = 0
+    heading = False
+    markdown_bold = False
+    # Перевод строки в начале позволяет распознать markdown и в первой строке
+    text = '\n' + text
+    position = 0
+
+    for match in _LLM_MARKUP_RE.finditer(text):
+        out.append(text[position:match.start()])
+        position = match.end()
+        kind = match.lastgroup
+
+        if match.group('newline'):
+            if (heading or markdown_bold) and 'b' in stack:
+                repairs += _close_html_tag(out, stack, 'b', openings)
+            heading = markdown_bold = False
+            out.append('\n')
+        literal = not _HTML_LITERAL_TAGS.isdisjoint(stack)
+
+        if kind == 'newline':
+            pass
+        elif literal and kind in ('bold', 'heading', 'bullet'):
+            # Код показывается как есть
+            out.append(match.group(kind))
+        elif kind == 'tag':
+            name = match.group('name').lower()
+            closing = match.group('closing')
+            if name in _HTML_HEADING_TAGS:
+                name = 'b'
+                repairs += 1
+            if heading and name == 'b':
+                # Заголовок и так жирный
+                repairs += 1
+            elif name in TELEGRAM_HTML_TAGS:
+                if closing:
+                    repairs += _close_html_tag(out, stack, name, openings)
+                else:
+                    opening = _opening_html_tag(name, match.group('attrs'))
+                    # Лишние атрибуты убираются, тег без нужных атрибутов - целиком
+                    repairs += opening is None or opening != f"<{name}{match.group('attrs')}>"
+                    if opening is not None:
+                        out.append(opening)
+                        stack.append(name)
+                        openings[name] = opening
+            else:
+                if name in _HTML_BREAK_TAGS:
+                    out.append('\n')
+                elif name == 'li' and not closing:
+                    out.append('• ')
+                repairs += 1
+        elif kind == 'entity':
+            out.append(match.group())
+        elif kind == 'bold':
+            marker = match.group()
+            if heading:
+                repairs += 1
+            elif markdown_bold:
+                repairs += 1 + _close_html_tag(out, stack, 'b', openings)
+                markdown_bold = False
+            elif text[position:position + 1].strip() and text.find(marker, position, _line_end(text, position)) != -1:
+                # Открываем жирный, только если он закроется в этой же строке
+                stack.append('b')
+                out.append('<b>')
+                markdown_bold = True
+                repairs += 1
+            else:
+                # Одиночные звездочки или подчеркивания - обычный текст
+                out.append(marker)
+        elif kind == 'heading':
+            stack.append('b')
+            out.append('<b>')
+            heading = True
+            repairs += 1
+        elif kind == 'bullet':
+            out.append('• ')
+            repairs += 1
+        else:
+            out.append(_HTML_ESCAPES[match.group()])
+            repairs += 1
+
+    out.append(text[position:])
+    repairs += len(stack)
+    out.extend(f'</{name}>' for name in reversed(stack))
+    return ''.join(out)[1:], repairs
+
+
+def validate_llm_content(kind, text):
+    """Исправленный текст ответа и вердикт.
+
+    'ok' - все разделы на месте, ответ можно кэшировать; 'incomplete' -
+    отправить можно, но не кэшировать; 'invalid' - лучше перегенерировать.
+    """
+    content, repairs = sanitize_llm_html(text.strip())
+    headings = ' '.join(_BOLD_SPAN_RE.findall(content)).upper()
+    missing = sum(1 for section in EXPECTED_SECTIONS[kind] if section not in headings)
+    if missing == 0:
+        verdict = 'ok'
+    elif missing <= LLM_MAX_MISSING_SECTIONS:
+        verdict = 'incomplete'
+    else:
+        verdict = 'invalid'
+
+    with _validation_counters_lock:
+        validation_counters[verdict] += 1
+        validation_counters['repaired'] += bool(repairs)
+    return content, verdict
+
+
 class GPT5HoroscopeService:
     def __init__(self):
         self.api_key = PROXYAPI_KEY
         self.base_url = PROXYAPI_BASE_URL
         self.model = "gpt-5-chat-latest"
+        self.content_cache = ContentCache()
+        # Идущие генерации: ключ контента -> (Future, приоритет)
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+        self._session = None
+
+    @property
+    def session(self):
+        """Keep-alive сессия к PROXY API (создается при первом запросе)"""
+        if self._session is None:
+            self._session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=LLM_MAX_CONCURRENCY)
+            self._session.mount('https://', adapter)
+            self._session.mount('http://', adapter)
+        return self._session
+
+    def horoscope_key(self, zodiac_sign, period, gender, day=None):
+        """Ключ контента гороскопа: период привязан к календарной корзине"""
+        return ('horoscope', zodiac_sign, period, gender, calendar_service.bucket(period, day))
+
+    def compatibility_key(self, sign1, gender1, sign2, gender2):
+        """Ключ контента совместимости"""
+        return ('compatibility', sign1, gender1, sign2, gender2)
+
+    def name_meaning_key(self, name):
+        """Ключ контента значения имени"""
+        return ('name', name.lower())
+
+    def _remember(self, key, result):
+        """Кэширует результат, если это настоящий ответ модели, а не резервный текст"""
+        if result.get('success') and not result.get('fallback') and not result.get('incomplete'):
+            self.content_cache.put(key, result)
+        return result
+
+    def _get_or_generate(self, key, generate, priority):
+        """Результат из кэша, из уже идущей генерации того же ключа или новой генерации.
+
+        Запрос, совпавший с идущей генерацией (например, предзагрузкой),
+        ждет ее результата вместо второго вызова LLM.
+        """
+        cached = self.content_cache.get(key)
+        tracer.annotate(content_cache='hit' if cached is not None else 'miss')
+        if cached is not None:
+            return cached
+
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = (Future(), priority)
+
+        if not leader:
+            tracer.annotate(content_cache='joined')
+            with tracer.span('join_generation'):
+                result = flight[0].result()
+            # Менее важная генерация могла отдать резервный текст: пробуем со своим приоритетом
+            if not (result.get('fallback') and flight[1] > priority):
+                return result
+            return self._remember(key, generate())
 
-    def get_horoscope(self, zodiac_sign, period, gender):
+        try:
+            result = self._remember(key, generate())
+        except BaseException as e:
+            flight[0].set_exception(e)
+            raise
+        else:
+            flight[0].set_result(result)
+            return result
+        finally:
+            with self._flights_lock:
+                del self._flights[key]
+
+    def get_horoscope(self, zodiac_sign, period, gender, priority=PRIORITY_USER, on_queue_position=None, day=None):
+        """Получение гороскопа с учетом пола (из кэша или через PROXY API)"""
+        day = day or calendar_service.today()
+        key = self.horoscope_key(zodiac_sign, period, gender, day)
+        return self._get_or_generate(key, partial(self._generate_horoscope, zodiac_sign, period, gender,
+                                                  priority, on_queue_position, day), priority)
+
+    def get_compatibility(self, sign1, gender1, sign2, gender2, priority=PRIORITY_USER, on_queue_position=None):
+        """Получение совместимости (из кэша или через PROXY API)"""
+        key = self.compatibility_key(sign1, gender1, sign2, gender2)
+        return self._get_or_generate(key, partial(self._generate_compatibility, sign1, gender1, sign2, gender2,
+                                                  priority, on_queue_position), priority)
+
+    def get_name_meaning(self, name, priority=PRIORITY_USER, on_queue_position=None):
+        """Получение значения имени (из кэша или через PROXY API)"""
+        key = self.name_meaning_key(name)
+        return self._get_or_generate(key, partial(self._generate_name_meaning, name, priority, on_queue_position),
+                                     priority)
+
+    def _generate_horoscope(self, zodiac_sign, period, gender, priority=PRIORITY_USER, on_queue_position=None,
+                            day=None):
         """Получение гороскопа через PROXY API с учетом пола"""
+        day = day or calendar_service.today()
         try:
             if not self.api_key:
                 logger.error("PROXYAPI_KEY not configured")
-                return self._get_fallback_horoscope(zodiac_sign, period, gender)
+                return self._get_fallback_horoscope(zodiac_sign, period, gender, day)
 
             zodiac_data = ZODIAC_SIGNS.get(zodiac_sign)
             if not zodiac_data:
-                return self._get_fallback_horoscope(zodiac_sign, period, gender)
+                return self._get_fallback_horoscope(zodiac_sign, period, gender, day)
 
-            prompt = self._build_horoscope_prompt(zodiac_data, period, gender)
+            with tracer.span('prompt_build'):
+                prompt = self._build_horoscope_prompt(zodiac_data, period, gender, day)
 
-            return self._make_api_request(prompt, zodiac_data, period, gender)
+            return self._make_api_request(prompt, zodiac_data, period, gender1=gender,
+                                          priority=priority, on_queue_position=on_queue_position, day=day)
 
         except Exception as e:
             logger.error(f"Horoscope generation failed: {str(e)}")
-            return self._get_fallback_horoscope(zodiac_sign, period, gender)
+            return self._get_fallback_horoscope(zodiac_sign, period, gender, day)
 
-    def get_compatibility(self, sign1, gender1, sign2, gender2):
+    def _generate_compatibility(self, sign1, gender1, sign2, gender2, priority=PRIORITY_USER, on_queue_position=None):
         """Получение совместимости через PROXY API"""
         try:
             if not self.api_key:
@@ -152,15 +1705,17 @@ class GPT5HoroscopeService:
             if not zodiac_data1 or not zodiac_data2:
                 return self._get_fallback_compatibility(sign1, gender1, sign2, gender2)
 
-            prompt = self._build_compatibility_prompt(zodiac_data1, gender1, zodiac_data2, gender2)
+            with tracer.span('prompt_build'):
+                prompt = self._build_compatibility_prompt(zodiac_data1, gender1, zodiac_data2, gender2)
 
-            return self._make_api_request(prompt, zodiac_data1, 'compatibility', zodiac_data2, gender1, gender2)
+            return self._make_api_request(prompt, zodiac_data1, 'compatibility', zodiac_data2, gender1, gender2,
+                                          priority=priority, on_queue_position=on_queue_position)
 
         except Exception as e:
             logger.error(f"Compatibility generation failed: {str(e)}")
             return self._get_fallback_compatibility(sign1, gender1, sign2, gender2)
 
-    def _build_horoscope_prompt(self, zodiac_data, period, gender):
+    def _build_horoscope_prompt(self, zodiac_data, period, gender, day=None):
         """Создание промпта для гороскопа с учетом пола"""
         period_names = {
             'today': 'сегодня',
@@ -171,13 +1726,14 @@ class GPT5HoroscopeService:
         }
 
         period_name = period_names.get(period, 'сегодня')
-        current_date = datetime.now().strftime("%d.%m.%Y")
+        day = day or calendar_service.today()
+        current_date = day.strftime("%d.%m.%Y")
 
         gender_text = "мужчины" if gender == 'мужчина' else "женщины"
 
         prompt = f"""
     СОСТАВЬ ПОДРОБНЫЙ ПЕРСОНАЛИЗИРОВАННЫЙ ГОРОСКОП ДЛЯ {gender_text.upper()} ЗНАКА {zodiac_data['name']} {zodiac_data['emoji']}
-    НА ПЕРИОД: {period_name} ({self._get_period_dates(period)})
+    НА ПЕРИОД: {period_name} ({self._get_period_dates(period, day)})
 
     ТЕКУЩАЯ ДАТА: {current_date}
 
@@ -293,8 +1849,8 @@ class GPT5HoroscopeService:
         }
         return traits.get(zodiac_name, '')
 
-    def _make_api_request(self, prompt, zodiac_data1, period, zodiac_data2=None, gender1=None, gender2=None):
-        """Общий метод для API запросов"""
+    def _post_chat_completion(self, system_prompt, prompt, priority=PRIORITY_USER, on_queue_position=None):
+        """HTTP-запрос к PROXY API через контроль допуска"""
         headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
@@ -303,24 +1859,83 @@ class GPT5HoroscopeService:
         data = {
             "model": self.model,
             "messages": [
-                {"role": "system", "content": self._get_system_prompt()},
+                {"role": "system", "content": system_prompt},
                 {"role": "user", "content": prompt}
             ],
         }
 
-        response = requests.post(
-            f"{self.base_url}/chat/completions",
-            headers=headers,
-            json=data,
-            timeout=30
-        )
-
-        if response.status_code == 200:
-            result = response.json()
-            content = result['choices'][0]['message']['content'].strip()
+        journal_key = None
+        if llm_journal.mode != 'off':
+            journal_key = llm_journal.key(self.model, system_prompt, prompt)
+        if llm_journal.mode == 'replay':
+            # Без сети и квоты провайдера, но с нашим лимитом одновременных генераций
+            with llm_admission.admit(priority, on_queue_position=on_queue_position):
+                with tracer.span('llm_request', model=self.model, journal='replay') as span:
+                    response = llm_journal.replay(journal_key)
+                    span['status'] = response.status_code
+            return response
+
+        estimated_tokens = estimate_tokens(system_prompt, prompt)
+        started = time.perf_counter()
+        for attempt in range(LLM_RATE_LIMIT_RETRIES + 1):
+            # Сначала квота провайдера, потом место среди одновременных генераций
+            with llm_quota.reserve(estimated_tokens, priority) as reservation:
+                with llm_admission.admit(priority, on_queue_position=on_queue_position):
+                    with tracer.span('llm_request', model=self.model, attempt=attempt) as span:
+                        reservation['sent'] = True
+                        try:
+                            response = self.session.post(
+                                f"{self.base_url}/chat/completions",
+                                headers=headers,
+                                json=data,
+                                timeout=30
+                            )
+                        except requests.exceptions.RequestException as e:
+                            reservation['sent'] = not request_never_sent(e)
+                            raise
+                        span['status'] = response.status_code
+                reservation['response'] = response
+            if response.status_code != 429:
+                break
+            # 429: планировщик приостановил отправку на Retry-After, повторяем после паузы
+            logger.error(f"PROXY API rate limited (attempt {attempt + 1})")
+
+        if journal_key:
+            # Только итоговый ответ с полной задержкой вместе с повторами: replay не повторяет 429
+            llm_journal.record(journal_key, self.model, response, time.perf_counter() - started)
+        return response
+
+    def _request_content(self, kind, system_prompt, prompt, priority=PRIORITY_USER, on_queue_position=None):
+        """Ответ модели с проверенной разметкой: (response, текст, полный ли ответ).
+
+        Ответ без большинства разделов перегенерируется; если и повтор не
+        удался, непустой текст отправляется, но не кэшируется.
+        """
+        for attempt in range(LLM_REGENERATE_ATTEMPTS + 1):
+            response = self._post_chat_completion(system_prompt, prompt, priority, on_queue_position)
+            if response.status_code != 200:
+                return response, None, False
+
+            raw_content = response.json()['choices'][0]['message']['content']
+            with tracer.span('validate_html') as span:
+                content, verdict = validate_llm_content(kind, raw_content)
+                span['verdict'] = verdict
+            if verdict != 'invalid':
+                break
+            logger.error(f"LLM {kind} response is missing sections (attempt {attempt + 1})")
+
+        return response, content, verdict == 'ok'
+
+    def _make_api_request(self, prompt, zodiac_data1, period, zodiac_data2=None, gender1=None, gender2=None,
+                          priority=PRIORITY_USER, on_queue_position=None, day=None):
+        """Общий метод для API запросов"""
+        kind = 'compatibility' if period == 'compatibility' else 'horoscope'
+        response, content, complete = self._request_content(kind, self._get_system_prompt(), prompt,
+                                                            priority, on_queue_position)
 
+        if response.status_code == 200 and content:
             if period == 'compatibility':
-                return {
+                result = {
                     'success': True,
                     'compatibility': content,
                     'zodiac1_name': zodiac_data1['name'],
@@ -331,23 +1946,26 @@ class GPT5HoroscopeService:
                     'gender2': gender2
                 }
             else:
-                return {
+                result = {
                     'success': True,
                     'horoscope': content,
-                    'period_dates': self._get_period_dates(period),
+                    'period_dates': self._get_period_dates(period, day),
                     'zodiac_name': zodiac_data1['name'],
                     'zodiac_emoji': zodiac_data1['emoji'],
                     'gender': gender1
                 }
+            if not complete:
+                result['incomplete'] = True
+            return result
         else:
             logger.error(f"API request failed: {response.status_code}")
             if period == 'compatibility':
                 return self._get_fallback_compatibility(
-                    zodiac_data1['name'].lower(), gender1,
-                    zodiac_data2['name'].lower(), gender2
+                    SIGN_IDS_BY_NAME[zodiac_data1['name']], gender1,
+                    SIGN_IDS_BY_NAME[zodiac_data2['name']], gender2
                 )
             else:
-                return self._get_fallback_horoscope(zodiac_data1['name'].lower(), period, gender1)
+                return self._get_fallback_horoscope(SIGN_IDS_BY_NAME[zodiac_data1['name']], period, gender1, day)
 
     def _get_system_prompt(self):
         """Системный промпт"""
@@ -359,29 +1977,11 @@ class GPT5HoroscopeService:
 Используй современные астрологические методики.
 """
 
-    def _get_period_dates(self, period):
+    def _get_period_dates(self, period, day=None):
         """Генерация дат для периодов"""
-        today = datetime.now()
-        months_ru = [
-            'январь', 'февраль', 'март', 'апрель', 'май', 'июнь',
-            'июль', 'август', 'сентябрь', 'октябрь', 'ноябрь', 'декабрь'
-        ]
-
-        if period == 'today':
-            return f"{today.day} {months_ru[today.month-1]}"
-        elif period == 'tomorrow':
-            tomorrow = today + timedelta(days=1)
-            return f"{tomorrow.day} {months_ru[tomorrow.month-1]}"
-        elif period == 'week':
-            return "неделя"
-        elif period == 'month':
-            return f"{months_ru[today.month-1]}"
-        elif period == 'year':
-            return f"{today.year}"
-        else:
-            return ""
+        return calendar_service.label(period, day)
 
-    def _get_fallback_horoscope(self, zodiac_sign, period, gender):
+    def _get_fallback_horoscope(self, zodiac_sign, period, gender, day=None):
         """Резервный гороскоп на случай ошибки"""
         zodiac_data = ZODIAC_SIGNS.get(zodiac_sign, {
             'name': 'Неизвестный знак',
@@ -410,10 +2010,16 @@ class GPT5HoroscopeService:
     <b>🎯 ПРАКТИЧЕСКИЕ РЕКОМЕНДАЦИИ</b>
     Составьте план действий и следуйте своей интуиции."""
 
+        # Заранее сгенерированный текст из офлайн-пакета лучше шаблона
+        packed_text = offline_pack.get(offline_pack_key('horoscope', zodiac_sign, period, gender))
+        if packed_text:
+            fallback_text = packed_text
+
         return {
             'success': True,
             'horoscope': fallback_text,
-            'period_dates': self._get_period_dates(period),
+            'fallback': True,
+            'period_dates': self._get_period_dates(period, day),
             'zodiac_name': zodiac_data['name'],
             'zodiac_emoji': zodiac_data['emoji'],
             'gender': gender
@@ -450,9 +2056,14 @@ class GPT5HoroscopeService:
     Находите компромиссы в спорных ситуациях
     Цените различия как возможность для роста"""
 
+        packed_text = offline_pack.get(offline_pack_key('compatibility', sign1, gender1, sign2, gender2))
+        if packed_text:
+            fallback_text = packed_text
+
         return {
             'success': True,
             'compatibility': fallback_text,
+            'fallback': True,
             'zodiac1_name': zodiac_data1['name'],
             'zodiac1_emoji': zodiac_data1['emoji'],
             'zodiac2_name': zodiac_data2['name'],
@@ -461,15 +2072,16 @@ class GPT5HoroscopeService:
             'gender2': gender2
         }
 
-    def get_name_meaning(self, name):
+    def _generate_name_meaning(self, name, priority=PRIORITY_USER, on_queue_position=None):
         """Получение значения имени через PROXY API"""
         try:
             if not self.api_key:
                 logger.error("PROXYAPI_KEY not configured")
                 return self._get_fallback_name_meaning(name)
 
-            prompt = self._build_name_meaning_prompt(name)
-            return self._make_name_api_request(prompt, name)
+            with tracer.span('prompt_build'):
+                prompt = self._build_name_meaning_prompt(name)
+            return self._make_name_api_request(prompt, name, priority, on_queue_position)
 
         except Exception as e:
             logger.error(f"Name meaning generation failed: {str(e)}")
@@ -514,37 +2126,20 @@ class GPT5HoroscopeService:
 
         return prompt
 
-    def _make_name_api_request(self, prompt, name):
+    def _make_name_api_request(self, prompt, name, priority=PRIORITY_USER, on_queue_position=None):
         """API запрос для анализа имени"""
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
-
-        data = {
-            "model": self.model,
-            "messages": [
-                {"role": "system", "content": self._get_system_prompt_for_names()},
-                {"role": "user", "content": prompt}
-            ],
-        }
-
-        response = requests.post(
-            f"{self.base_url}/chat/completions",
-            headers=headers,
-            json=data,
-            timeout=30
-        )
-
-        if response.status_code == 200:
-            result = response.json()
-            content = result['choices'][0]['message']['content'].strip()
+        response, content, complete = self._request_content('name_meaning', self._get_system_prompt_for_names(),
+                                                            prompt, priority, on_queue_position)
 
-            return {
+        if response.status_code == 200 and content:
+            result = {
                 'success': True,
                 'name_meaning': content,
                 'name': name
             }
+            if not complete:
+                result['incomplete'] = True
+            return result
         else:
             logger.error(f"Name API request failed: {response.status_code}")
             return self._get_fallback_name_meaning(name)
@@ -589,14 +2184,60 @@ class GPT5HoroscopeService:
     Развивайте терпение и умение слушать других.
     Используйте свои коммуникативные навыки для построения карьеры."""
 
+        packed_text = offline_pack.get(offline_pack_key('name', name.lower()))
+        if packed_text:
+            fallback_text = packed_text
+
         return {
             'success': True,
             'name_meaning': fallback_text,
+            'fallback': True,
             'name': name
         }
 
+class RenderedResponseCache:
+    """Кэш готовых к отправке частей сообщений.
+
+    Запись хранит разбитый на части текст вместе с уже сериализованной
+    клавиатурой (сжатыми тем же кодеком) и действительна, пока не сменилось
+    поколение контента с тем же ключом в ContentCache. ContentCache сообщает
+    об обновлении, вытеснении и истечении срока своих записей, поэтому здесь
+    не бывает больше записей, чем в нем.
+    """
+
+    def __init__(self, content_cache):
+        self.content_cache = content_cache
+        self.codec = content_cache.codec
+        self._entries = {}
+        content_cache.subscribe(self.invalidate)
+
+    def get(self, key):
+        """Готовые части сообщения или None"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] != self.content_cache.generation(key):
+            self._entries.pop(key, None)
+            return None
+        return tuple(tuple(part) for part in json.loads(self.codec.decompress(entry[1])))
+
+    def put(self, key, parts):
+        """Сохраняет части, привязывая их к текущему поколению контента"""
+        generation = self.content_cache.generation(key)
+        if generation is None:
+            return
+        self._entries[key] = (generation, self.codec.compress(json.dumps(parts, ensure_ascii=False)))
+        # Контент мог смениться или уйти из кэша, пока части сжимались
+        if self.content_cache.generation(key) != generation:
+            self._entries.pop(key, None)
+
+    def invalidate(self, key):
+        """Сброс записи при обновлении контента"""
+        self._entries.pop(key, None)
+
 # Создаем экземпляр сервиса
 horoscope_service = GPT5HoroscopeService()
+rendered_responses = RenderedResponseCache(horoscope_service.content_cache)
 
 # Создаем клавиатуры
 def get_main_menu_keyboard():
@@ -622,6 +2263,23 @@ def get_gender_keyboard():
     keyboard.row(buttons[2])
     return keyboard
 
+def get_delivery_time_keyboard():
+    """Клавиатура выбора времени рассылки"""
+    keyboard = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=4)
+    keyboard.row('07:00', '08:00', '09:00', '10:00')
+    keyboard.row('12:00', '18:00', '20:00', '22:00')
+    keyboard.row('🔙 Назад')
+    return keyboard
+
+def get_timezone_keyboard():
+    """Клавиатура выбора часового пояса"""
+    keyboard = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
+    labels = list(TIMEZONE_CHOICES)
+    for i in range(0, len(labels), 2):
+        keyboard.row(*labels[i:i+2])
+    keyboard.row('🔙 Назад')
+    return keyboard
+
 def get_zodiac_keyboard():
     """Клавиатура с знаками зодиака"""
     keyboard = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=3)
@@ -637,22 +2295,17 @@ def get_zodiac_keyboard():
     keyboard.row('🔙 Назад')
     return keyboard
 
-def get_period_keyboard():
+def get_period_keyboard(day=None):
     """Клавиатура с периодами"""
     keyboard = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
 
-    today = datetime.now()
-    months_ru = [
-        'январь', 'февраль', 'март', 'апрель', 'май', 'июнь',
-        'июль', 'август', 'сентябрь', 'октябрь', 'ноябрь', 'декабрь'
-    ]
+    day = day or calendar_service.today()
 
-    today_text = f"Сегодня ({today.day} {months_ru[today.month-1]})"
-    tomorrow = today + timedelta(days=1)
-    tomorrow_text = f"Завтра ({tomorrow.day} {months_ru[tomorrow.month-1]})"
+    today_text = f"Сегодня ({calendar_service.label('today', day)})"
+    tomorrow_text = f"Завтра ({calendar_service.label('tomorrow', day)})"
     week_text = "Неделя"
-    month_text = f"Месяц ({months_ru[today.month-1]})"
-    year_text = f"Год ({today.year})"
+    month_text = f"Месяц ({calendar_service.label('month', day)})"
+    year_text = f"Год ({calendar_service.label('year', day)})"
 
     buttons = [today_text, tomorrow_text, week_text, month_text, year_text, '🔙 Назад']
 
@@ -663,6 +2316,7 @@ def get_period_keyboard():
 
 @bot.message_handler(commands=['start'])
 @logger.catch
+@traced_handler
 def welcome(message: telebot.types.Message) -> None:
     """Приветственное сообщение"""
     chat_id = message.chat.id
@@ -676,12 +2330,14 @@ def welcome(message: telebot.types.Message) -> None:
 
 ✨ <b>Выбери что тебя интересует:</b>"""
 
+    bot.forget_keyboard(chat_id)
     bot.send_message(chat_id, welcome_text,
                     reply_markup=get_main_menu_keyboard(),
                     parse_mode='HTML')
 
 @bot.message_handler(func=lambda message: message.text == '🔮 Получить гороскоп')
 @logger.catch
+@traced_handler
 def horoscope_start(message: telebot.types.Message) -> None:
     """Начало получения гороскопа"""
     chat_id = message.chat.id
@@ -693,6 +2349,7 @@ def horoscope_start(message: telebot.types.Message) -> None:
 
 @bot.message_handler(func=lambda message: message.text == '💑 Проверить совместимость')
 @logger.catch
+@traced_handler
 def compatibility_start(message: telebot.types.Message) -> None:
     """Начало проверки совместимости"""
     chat_id = message.chat.id
@@ -704,6 +2361,7 @@ def compatibility_start(message: telebot.types.Message) -> None:
 
 @bot.message_handler(func=lambda message: message.text == '📛 Значение имени')
 @logger.catch
+@traced_handler
 def name_meaning_start(message: telebot.types.Message) -> None:
     """Начало получения значения имени"""
     chat_id = message.chat.id
@@ -714,8 +2372,50 @@ def name_meaning_start(message: telebot.types.Message) -> None:
                      reply_markup=get_name_input_keyboard(),
                      parse_mode='HTML')
 
+@bot.message_handler(commands=['subscribe'])
+@logger.catch
+@traced_handler
+def subscribe_start(message: telebot.types.Message) -> None:
+    """Начало оформления подписки на ежедневный гороскоп"""
+    chat_id = message.chat.id
+    user_data[chat_id] = {'mode': 'subscribe', 'step': 'gender'}
+
+    bot.send_message(chat_id, "🔔 <b>Ежедневный гороскоп</b>\n\n👤 <b>Выбери свой пол:</b>",
+                    reply_markup=get_gender_keyboard(),
+                    parse_mode='HTML')
+
+@bot.message_handler(commands=['unsubscribe'])
+@logger.catch
+@traced_handler
+def unsubscribe_command(message: telebot.types.Message) -> None:
+    """Отключение ежедневной рассылки"""
+    chat_id = message.chat.id
+
+    if subscription_store.unsubscribe(chat_id):
+        text = "🔕 <b>Подписка отключена.</b> Возвращайся, когда захочешь: /subscribe"
+    else:
+        text = "У тебя нет активной подписки. Оформить: /subscribe"
+
+    bot.send_message(chat_id, text,
+                    reply_markup=get_main_menu_keyboard(),
+                    parse_mode='HTML')
+
+@bot.message_handler(commands=['timezone'])
+@logger.catch
+@traced_handler
+def timezone_start(message: telebot.types.Message) -> None:
+    """Выбор часового пояса: от него зависят "сегодня" и время рассылки"""
+    chat_id = message.chat.id
+    user_data[chat_id] = {'mode': 'timezone', 'step': 'timezone'}
+    timezone = subscription_store.timezone(chat_id) or DEFAULT_TIMEZONE
+
+    bot.send_message(chat_id, f"🌍 <b>Часовой пояс</b>\n\nСейчас: {timezone}. Выбери свой:",
+                    reply_markup=get_timezone_keyboard(),
+                    parse_mode='HTML')
+
 @bot.message_handler(func=lambda message: message.text in ['👨 Мужчина', '👩 Женщина'])
 @logger.catch
+@traced_handler
 def handle_gender_selection(message: telebot.types.Message) -> None:
     """Обработчик выбора пола"""
     chat_id = message.chat.id
@@ -725,10 +2425,11 @@ def handle_gender_selection(message: telebot.types.Message) -> None:
         return
 
     gender = 'мужчина' if message.text == '👨 Мужчина' else 'женщина'
-    mode = user_data[chat_id]['mode']
-    step = user_data[chat_id]['step']
+    with tracer.span('session_load'):
+        mode = user_data[chat_id]['mode']
+        step = user_data[chat_id]['step']
 
-    if mode == 'horoscope' and step == 'gender':
+    if mode in ('horoscope', 'subscribe') and step == 'gender':
         user_data[chat_id].update({
             'gender': gender,
             'step': 'zodiac'
@@ -754,6 +2455,7 @@ def handle_gender_selection(message: telebot.types.Message) -> None:
 
 @bot.message_handler(func=lambda message: any(sign_data['name'] in message.text for sign_data in ZODIAC_SIGNS.values()))
 @logger.catch
+@traced_handler
 def handle_zodiac_selection(message: telebot.types.Message) -> None:
     """Обработчик выбора знака зодиака"""
     chat_id = message.chat.id
@@ -775,13 +2477,17 @@ def handle_zodiac_selection(message: telebot.types.Message) -> None:
         bot.send_message(chat_id, "Пожалуйста, начните с выбора функции из главного меню.")
         return
 
-    mode = user_data[chat_id]['mode']
-    step = user_data[chat_id]['step']
+    with tracer.span('session_load'):
+        mode = user_data[chat_id]['mode']
+        step = user_data[chat_id]['step']
 
     if mode == 'horoscope' and step == 'zodiac':
+        # Дата, от которой построена клавиатура периодов: по ней же считается ответ
+        day = calendar_service.today(subscription_store.timezone(chat_id))
         user_data[chat_id].update({
             'zodiac_sign': selected_sign,
-            'step': 'period'
+            'step': 'period',
+            'calendar_day': day.isoformat()
         })
         zodiac_data = ZODIAC_SIGNS[selected_sign]
 
@@ -795,7 +2501,22 @@ def handle_zodiac_selection(message: telebot.types.Message) -> None:
 <b>Теперь выбери период для гороскопа:</b>"""
 
         bot.send_message(chat_id, response_text,
-                        reply_markup=get_period_keyboard(),
+                        reply_markup=get_period_keyboard(day),
+                        parse_mode='HTML')
+        prefetch_horoscope(selected_sign, user_data[chat_id]['gender'], day)
+
+    elif mode == 'subscribe' and step == 'zodiac':
+        user_data[chat_id].update({
+            'zodiac_sign': selected_sign,
+            'step': 'delivery_time'
+        })
+        zodiac_data = ZODIAC_SIGNS[selected_sign]
+
+        bot.send_message(chat_id,
+                        f"✅ <b>Знак: {zodiac_data['emoji']} {zodiac_data['name']}</b>\n\n"
+                        f"⏰ <b>В какое время присылать гороскоп?</b>\n"
+                        f"<i>Выбери вариант или введи время в формате ЧЧ:ММ</i>",
+                        reply_markup=get_delivery_time_keyboard(),
                         parse_mode='HTML')
 
     elif mode == 'compatibility':
@@ -809,6 +2530,8 @@ def handle_zodiac_selection(message: telebot.types.Message) -> None:
             bot.send_message(chat_id, f"✨ <b>Теперь выбери знак зодиака {gender_text}:</b>",
                             reply_markup=get_zodiac_keyboard(),
                             parse_mode='HTML')
+            prefetch_compatibility(selected_sign, user_data[chat_id]['first_gender'],
+                                   user_data[chat_id]['second_gender'])
 
         elif step == 'second_zodiac':
             user_data[chat_id].update({
@@ -820,19 +2543,196 @@ def handle_zodiac_selection(message: telebot.types.Message) -> None:
             first_gender = user_data[chat_id]['first_gender']
             second_sign = user_data[chat_id]['second_sign']
             second_gender = user_data[chat_id]['second_gender']
+            prefetch_policy.observe('second_zodiac', first_sign, second_sign)
+
+            deliver_compatibility(chat_id, first_sign, first_gender, second_sign, second_gender)
+
+# Лимит Telegram на длину сообщения считается в UTF-16 code units
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+_HTML_TAG_RE = re.compile(r'<(/?)([a-zA-Z]+)[^<>]*>')
+# Ответ Bot API на разметку, которую Telegram не смог разобрать
+TELEGRAM_PARSE_ERROR = "can't parse entities"
+_LINE_RE = re.compile(r'[^\n]*\n|[^\n]+')
+_SENTENCE_RE = re.compile(r'.*?(?:\. |\Z)', re.DOTALL)
+
+
+def utf16_len(text):
+    """Длина строки в UTF-16 code units (так считает Telegram)"""
+    if text.isascii():
+        return len(text)
+    return len(text.encode('utf-16-le')) // 2
+
+
+def _closing_tags(stack):
+    """Закрывающие теги для открытых тегов"""
+    return ''.join(f'</{name}>' for name, _ in reversed(stack))
+
+
+def _opening_tags(stack):
+    """Повторное открытие тегов в начале следующей части"""
+    return ''.join(tag for _, tag in stack)
+
+
+def _advance_tag_stack(stack, chunk):
+    """Обновляет стек открытых HTML-тегов после фрагмента текста"""
+    if '<' not in chunk:
+        return stack
+
+    stack = list(stack)
+    for match in _HTML_TAG_RE.finditer(chunk):
+        closing, name = match.group(1), match.group(2).lower()
+        if not closing:
+            stack.append((name, match.group(0)))
+            continue
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i][0] == name:
+                del stack[i]
+                break
+    return tuple(stack)
+
+
+def _safe_cut(chunk, pos):
+    """Сдвигает позицию разреза так, чтобы не попасть внутрь тега или сущности"""
+    tag_start = chunk.rfind('<', 0, pos)
+    if tag_start != -1 and chunk.find('>', tag_start, pos) == -1:
+        pos = tag_start
+    entity_start = chunk.rfind('&', 0, pos)
+    if entity_start != -1 and ';' not in chunk[entity_start:pos] and pos - entity_start < 10:
+        pos = entity_start
+    return pos
+
+
+def _iter_units(text, max_unit):
+    """Неделимые фрагменты текста: строки, а для слишком длинных строк - предложения и куски"""
+    for line_match in _LINE_RE.finditer(text):
+        line = line_match.group(0)
+        if utf16_len(line) <= max_unit:
+            yield line
+            continue
+
+        for sentence_match in _SENTENCE_RE.finditer(line):
+            sentence = sentence_match.group(0)
+            while sentence:
+                if utf16_len(sentence) <= max_unit:
+                    yield sentence
+                    break
+                # Кусок не длиннее max_unit даже в UTF-16 (символ занимает максимум 2 единицы)
+                cut = _safe_cut(sentence, max_unit // 2) or max_unit // 2
+                yield sentence[:cut]
+                sentence = sentence[cut:]
+
+
+def iter_message_parts(text, max_length=4000):
+    """Разделяет длинное сообщение на части за один проход.
+
+    Части выдаются генератором. Разрез предпочтительно делается перед
+    заголовком раздела (<b>...), теги остаются сбалансированными в каждой
+    части, длина считается в UTF-16 code units.
+    """
+    if utf16_len(text) <= max_length:
+        yield text
+        return
+
+    # Буфер текущей части: (фрагмент, длина, начало раздела, стек тегов до фрагмента)
+    pending = []
+    pending_size = 0
+    stack = ()
+    prefix = ''
+    prefix_size = 0
+
+    def flush(count):
+        nonlocal pending, pending_size, prefix, prefix_size
+        head, pending = pending[:count], pending[count:]
+        stack_at_cut = pending[0][3] if pending else stack
+        part = prefix + ''.join(unit[0] for unit in head) + _closing_tags(stack_at_cut)
+        pending_size -= sum(unit[1] for unit in head)
+        prefix = _opening_tags(stack_at_cut)
+        prefix_size = utf16_len(prefix)
+        return part
+
+    for chunk in _iter_units(text, max_length // 2):
+        size = utf16_len(chunk)
+        stack_after = _advance_tag_stack(stack, chunk)
+        closing_size = utf16_len(_closing_tags(stack_after))
+
+        while pending and prefix_size + pending_size + size + closing_size > max_length:
+            # Ищем последний заголовок раздела во второй половине части
+            cut = len(pending)
+            filled = prefix_size + pending_size
+            for i in range(len(pending) - 1, 0, -1):
+                filled -= pending[i][1]
+                if filled < max_length // 2:
+                    break
+                if pending[i][2]:
+                    cut = i
+                    break
+            part = flush(cut)
+            if part.strip():
+                yield part
+
+        pending.append((chunk, size, chunk.lstrip().startswith('<b>'), stack))
+        pending_size += size
+        stack = stack_after
+
+    if pending:
+        part = flush(len(pending))
+        if part.strip():
+            yield part
+
+
+def split_long_message(text, max_length=4000):
+    """Разделяет длинное сообщение на части"""
+    return list(iter_message_parts(text, max_length))
+
+@lru_cache(maxsize=None)
+def get_main_menu_markup():
+    """Сериализованная клавиатура главного меню (строится один раз)"""
+    return get_main_menu_keyboard().to_json()
 
-            zodiac1 = ZODIAC_SIGNS[first_sign]
-            zodiac2 = ZODIAC_SIGNS[second_sign]
+def format_horoscope_message(result, zodiac_sign, period, gender):
+    """Полный текст сообщения с гороскопом"""
+    zodiac_data = ZODIAC_SIGNS[zodiac_sign]
 
-            loading_msg = bot.send_message(chat_id, "💞 <i>Анализирую совместимость ... Это займет несколько секунд.</i>",
-                                          parse_mode='HTML')
+    # Форматируем период для отображения
+    period_display = {
+        'today': 'Сегодня',
+        'tomorrow': 'Завтра',
+        'week': 'Неделя',
+        'month': 'Месяц',
+        'year': 'Год'
+    }.get(period, period)
 
-            result = horoscope_service.get_compatibility(first_sign, first_gender, second_sign, second_gender)
+    gender_text = "мужчины" if gender == 'мужчина' else "женщины"
 
-            bot.delete_message(chat_id, loading_msg.message_id)
+    header = f"""
+{zodiac_data['emoji']} <b>ПЕРСОНАЛИЗИРОВАННЫЙ ГОРОСКОП ДЛЯ {gender_text.upper()}</b> {zodiac_data['emoji']}
+📅 <b>Период:</b> {period_display} ({result['period_dates']})
+👤 <b>Знак:</b> {zodiac_data['name']} | <b>Пол:</b> {gender}
+
+"""
+
+    footer = "\n\n✨ <i>Пусть звезды благоволят вам!</i>"
 
-            if result['success']:
-                response = f"""
+    return header + result['horoscope'] + footer
+
+def render_horoscope_parts(result, zodiac_sign, period, gender):
+    """Готовые части сообщения с гороскопом: [(текст, клавиатура), ...]"""
+    message = format_horoscope_message(result, zodiac_sign, period, gender)
+
+    # Первая часть с клавиатурой, остальные - без
+    with tracer.span('split'):
+        return tuple(
+            (part, get_main_menu_markup() if i == 0 else None)
+            for i, part in enumerate(iter_message_parts(message))
+        )
+
+def render_compatibility_parts(result, first_sign, first_gender, second_sign, second_gender):
+    """Готовые части сообщения с совместимостью: [(текст, клавиатура), ...]"""
+    zodiac1 = ZODIAC_SIGNS[first_sign]
+    zodiac2 = ZODIAC_SIGNS[second_sign]
+
+    response = f"""
 💑 <b>СОВМЕСТИМОСТЬ</b> 💑
 
 👤 {first_gender.capitalize()} {zodiac1['emoji']} <b>{zodiac1['name']}</b>
@@ -843,43 +2743,905 @@ def handle_zodiac_selection(message: telebot.types.Message) -> None:
 
 ✨ <i>Пусть ваши отношения будут гармоничными!</i>"""
 
-                bot.send_message(chat_id, response,
-                                reply_markup=get_main_menu_keyboard(),
-                                parse_mode='HTML')
+    with tracer.span('split'):
+        return tuple(
+            (part, get_main_menu_markup() if i == 0 else None)
+            for i, part in enumerate(iter_message_parts(response))
+        )
+
+def render_name_meaning_parts(result, name):
+    """Готовые части сообщения со значением имени: [(текст, клавиатура), ...]"""
+    header = f"📛 <b>ЗНАЧЕНИЕ ИМЕНИ: {name.upper()}</b>\n\n"
+
+    with tracer.span('split'):
+        message_parts = split_long_message(header + result['name_meaning'])
+
+    # Последняя часть с клавиатурой, промежуточные - без
+    return tuple(
+        (part, get_main_menu_markup() if i == len(message_parts) - 1 else None)
+        for i, part in enumerate(message_parts)
+    )
+
+def html_to_plain_text(text):
+    """Текст части без HTML-разметки и сущностей"""
+    return html.unescape(_HTML_TAG_RE.sub('', text))
+
+def send_rendered_parts(chat_id, parts, loading_message=None):
+    """Отправка готовых частей сообщения.
+
+    Если есть сообщение о загрузке, первая часть заменяет его через
+    edit_message_text вместо удаления и новой отправки. Часть, разметку
+    которой Telegram не принял, отправляется простым текстом.
+    """
+    if loading_message is not None:
+        text, _ = parts[0]
+        try:
+            bot.edit_message_text(text, chat_id, loading_message.message_id, parse_mode='HTML')
+            parts = parts[1:]
+        except telebot.apihelper.ApiTelegramException:
+            bot.delete_message(chat_id, loading_message.message_id)
+            # Первая часть уходит новым сообщением: клавиатуру отправляем заново
+            bot.forget_keyboard(chat_id)
+
+    for text, markup in parts:
+        try:
+            bot.send_message(chat_id, text, reply_markup=markup, parse_mode='HTML')
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code != 400 or TELEGRAM_PARSE_ERROR not in e.description:
+                raise
+            # Повтор с той же разметкой упадет так же: отправляем текст без нее
+            logger.error(f"Telegram rejected HTML for chat {chat_id}: {e.description}")
+            bot.send_message(chat_id, html_to_plain_text(text), reply_markup=markup)
+
+
+# Счетчики подавленных и ограниченных запросов (у каждого арендатора свои)
+request_counters = TenantScoped('request_counters')
+_request_counters_lock = threading.Lock()
+
+def count_request(name):
+    """Увеличение счетчика запросов"""
+    with _request_counters_lock:
+        request_counters[name] += 1
+
+
+# Ограничение дорогих генераций на один чат: не больше 5 в минуту
+CHAT_RATE_LIMIT = 5
+CHAT_RATE_PERIOD = 60
+CHAT_RATE_MAX_CHATS = 50000
+
+
+class ChatRateLimiter:
+    """Ограничение частоты дорогих запросов для каждого чата"""
+
+    def __init__(self, limit=CHAT_RATE_LIMIT, period=CHAT_RATE_PERIOD, max_chats=CHAT_RATE_MAX_CHATS):
+        self.limit = limit
+        self.period = period
+        self.max_chats = max_chats
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, chat_id):
+        """True, если чат еще не исчерпал лимит"""
+        with self._lock:
+            bucket = self._buckets.get(chat_id)
+            if bucket is None:
+                bucket = self._buckets[chat_id] = TokenBucket(self.limit / self.period, self.limit)
+                if len(self._buckets) > self.max_chats:
+                    self._buckets.popitem(last=False)
             else:
-                bot.send_message(chat_id,
-                                "❌ Извините, произошла ошибка при анализе совместимости. Попробуйте позже.",
-                                reply_markup=get_main_menu_keyboard())
+                self._buckets.move_to_end(chat_id)
+        return bucket.try_acquire()
 
-def split_long_message(text, max_length=4000):
-    """Разделяет длинное сообщение на части"""
-    if len(text) <= max_length:
-        return [text]
 
-    parts = []
-    while text:
-        if len(text) <= max_length:
-            parts.append(text)
-            break
+chat_rate_limiter = TenantScoped('chat_rate_limiter')
 
-        # Находим последний перенос строки в пределах лимита
-        split_pos = text.rfind('\n', 0, max_length)
-        if split_pos == -1:
-            # Если нет переносов, разбиваем по предложениям
-            split_pos = text.rfind('. ', 0, max_length)
-            if split_pos == -1:
-                # Если нет точек, просто обрезаем
-                split_pos = max_length
 
-        parts.append(text[:split_pos + 1])
-        text = text[split_pos + 1:]
+class InFlightJobs:
+    """Реестр генераций, которые сейчас выполняются для пользователей.
 
-    return parts
+    Одинаковый запрос того же чата, пока первый не завершен, не выполняется
+    повторно. При остановке реестр позволяет дождаться генераций, а
+    незавершенные сохранить и выполнить заново после перезапуска.
+    """
+
+    def __init__(self):
+        self._jobs = {}
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def track(self, chat_id, kind, args):
+        """Регистрирует генерацию на время ее выполнения и отправки.
+
+        Возвращает запись генерации или None, если такая же генерация для
+        этого чата уже выполняется.
+        """
+        job_key = (chat_id, kind, tuple(args))
+        with self._condition:
+            existing = self._jobs.get(job_key)
+            if existing is not None:
+                existing['duplicates'] += 1
+                job = None
+            else:
+                job = self._jobs[job_key] = {'chat_id': chat_id, 'kind': kind, 'args': list(args), 'duplicates': 0}
+        if job is None:
+            yield None
+            return
+
+        try:
+            yield job
+        finally:
+            with self._condition:
+                del self._jobs[job_key]
+                self._condition.notify_all()
+
+    def duplicates(self, chat_id, kind, args):
+        """Сколько повторов уже пришло для выполняющейся генерации"""
+        with self._condition:
+            job = self._jobs.get((chat_id, kind, tuple(args)))
+            return job['duplicates'] if job else 0
+
+    def wait_idle(self, timeout):
+        """Ожидание завершения всех генераций. True, если реестр опустел"""
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._jobs, timeout)
+
+    def snapshot(self):
+        """Список незавершенных генераций"""
+        with self._condition:
+            return [
+                {'chat_id': job['chat_id'], 'kind': job['kind'], 'args': job['args']}
+                for job in self._jobs.values()
+            ]
+
+
+inflight_jobs = TenantScoped('inflight_jobs')
+
+
+def _deliver(chat_id, kind, args, content_key, loading_text, generate, render, error_text):
+    """Общий путь ответа: готовые части из кэша или генерация с сообщением о загрузке"""
+    # Готовый ответ из кэша отправляется без сообщения о загрузке
+    parts = rendered_responses.get(content_key)
+    if parts is not None:
+        send_rendered_parts(chat_id, parts)
+        return True
+
+    # Контент уже сгенерирован (например, предзагрузкой): только отрисовка
+    result = horoscope_service.content_cache.get(content_key)
+    if result is not None:
+        parts = render(result, *args)
+        rendered_responses.put(content_key, parts)
+        send_rendered_parts(chat_id, parts)
+        return True
+
+    with inflight_jobs.track(chat_id, kind, args) as job:
+        if job is None:
+            # Повторное нажатие, пока ответ готовится: подтверждаем один раз
+            count_request('duplicate_suppressed')
+            if inflight_jobs.duplicates(chat_id, kind, args) == 1:
+                bot.send_message(chat_id, "⏳ Уже готовлю ответ, он придет через несколько секунд.")
+            return False
+
+        if not chat_rate_limiter.allow(chat_id):
+            count_request('rate_limited')
+            bot.send_message(chat_id, "⏳ Слишком много запросов. Попробуйте через минуту.",
+                             reply_markup=get_main_menu_keyboard())
+            return False
+
+        count_request('generation_started')
+
+        # Сообщение о загрузке сразу несет клавиатуру главного меню: тогда его
+        # можно превратить в ответ через edit_message_text, а клавиатура уже показана
+        loading_msg = bot.send_message(chat_id, loading_text,
+                                       reply_markup=get_main_menu_markup(),
+                                       parse_mode='HTML')
+
+        def show_queue_position(position):
+            try:
+                bot.edit_message_text(f"{loading_text}\n\n⏳ <i>Много запросов, вы в очереди: {position}</i>",
+                                      chat_id, loading_msg.message_id, parse_mode='HTML')
+            except telebot.apihelper.ApiTelegramException:
+                pass
+
+        result = generate(*args, on_queue_position=show_queue_position)
+
+        if not result['success']:
+            bot.edit_message_text(error_text, chat_id, loading_msg.message_id)
+            return False
+
+        parts = render(result, *args)
+        rendered_responses.put(content_key, parts)
+        send_rendered_parts(chat_id, parts, loading_msg)
+    return True
+
+def deliver_horoscope(chat_id, zodiac_sign, period, gender, day=None):
+    """Отправка гороскопа пользователю на период от даты day"""
+    day = day or calendar_service.today()
+    return _deliver(
+        chat_id, 'horoscope', (zodiac_sign, period, gender),
+        horoscope_service.horoscope_key(zodiac_sign, period, gender, day),
+        "🔮 <i>Составляю ваш персональный гороскоп... Это займет несколько секунд.</i>",
+        partial(horoscope_service.get_horoscope, day=day), render_horoscope_parts,
+        "❌ Извините, произошла ошибка при генерации гороскопа. Попробуйте позже."
+    )
+
+def deliver_compatibility(chat_id, first_sign, first_gender, second_sign, second_gender):
+    """Отправка анализа совместимости пользователю"""
+    return _deliver(
+        chat_id, 'compatibility', (first_sign, first_gender, second_sign, second_gender),
+        horoscope_service.compatibility_key(first_sign, first_gender, second_sign, second_gender),
+        "💞 <i>Анализирую совместимость ... Это займет несколько секунд.</i>",
+        horoscope_service.get_compatibility, render_compatibility_parts,
+        "❌ Извините, произошла ошибка при анализе совместимости. Попробуйте позже."
+    )
+
+def deliver_name_meaning(chat_id, name):
+    """Отправка значения имени пользователю"""
+    return _deliver(
+        chat_id, 'name_meaning', (name,),
+        horoscope_service.name_meaning_key(name),
+        f"📛 <i>Анализирую имя '{name}'... Это займет несколько секунд.</i>",
+        horoscope_service.get_name_meaning, render_name_meaning_parts,
+        "❌ Извините, произошла ошибка при анализе имени. Попробуйте позже."
+    )
+
+# Функции для повторного выполнения генераций после перезапуска
+JOB_DELIVERERS = {
+    'horoscope': deliver_horoscope,
+    'compatibility': deliver_compatibility,
+    'name_meaning': deliver_name_meaning,
+}
+
+# Фоновая генерация контента (не блокирует обработчики)
+BACKGROUND_WORKERS = 2
+background_executor = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix='background')
+_scheduled_generations = set()
+
+def schedule_horoscope_generation(zodiac_sign, period, gender, day=None):
+    """Ставит генерацию гороскопа в фоновую очередь, если она еще не запланирована"""
+    content_key = horoscope_service.horoscope_key(zodiac_sign, period, gender, day)
+    if content_key in _scheduled_generations:
+        return
+    _scheduled_generations.add(content_key)
+
+    def generate():
+        try:
+            horoscope_service.get_horoscope(zodiac_sign, period, gender, priority=PRIORITY_BACKGROUND, day=day)
+        finally:
+            _scheduled_generations.discard(content_key)
+
+    background_executor.submit(generate)
+
+# Настройки подписки на ежедневный гороскоп
+SUBSCRIPTIONS_DB_PATH = 'subscriptions.db'
+# Глобальный лимит Telegram ~30 сообщений в секунду, часть оставляем интерактивным ответам
+BROADCAST_RATE_LIMIT = 25
+# Запас токенов: после паузы рассылка не выдает больше BROADCAST_RATE_LIMIT + BROADCAST_BURST за секунду
+BROADCAST_BURST = 5
+BROADCAST_CHECK_INTERVAL = 30
+# За сколько секунд до времени доставки гороскоп ставится в фоновую генерацию
+BROADCAST_PREGENERATE_AHEAD = 30 * 60
+BROADCAST_MAX_ATTEMPTS = 3
+# Параллельные отправки: при задержке Bot API 50-100 мс один поток не выбирает лимит
+BROADCAST_SEND_WORKERS = 8
+
+
+class TokenBucket:
+    """Потокобезопасный ограничитель скорости (token bucket)"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1):
+        """Забирает токены, если они есть, без ожидания"""
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1):
+        """Забирает токены, при необходимости дожидаясь их накопления"""
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class SubscriptionStore:
+    """Хранилище подписок и статусов доставки рассылки (SQLite)"""
+
+    def __init__(self, path=SUBSCRIPTIONS_DB_PATH):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS subscribers (
+                    chat_id INTEGER PRIMARY KEY,
+                    zodiac_sign TEXT NOT NULL,
+                    gender TEXT NOT NULL,
+                    delivery_time TEXT NOT NULL,
+                    timezone TEXT NOT NULL,
+                    active INTEGER NOT NULL DEFAULT 1
+                );
+                CREATE INDEX IF NOT EXISTS subscribers_due
+                    ON subscribers (active, timezone, delivery_time);
+                CREATE TABLE IF NOT EXISTS chat_timezones (
+                    chat_id INTEGER PRIMARY KEY,
+                    timezone TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS deliveries (
+                    chat_id INTEGER NOT NULL,
+                    bucket TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    PRIMARY KEY (chat_id, bucket)
+                );
+            """)
+
+    def subscribe(self, chat_id, zodiac_sign, gender, delivery_time, timezone=DEFAULT_TIMEZONE):
+        """Создание или обновление подписки"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO subscribers VALUES (?, ?, ?, ?, ?, 1)",
+                (chat_id, zodiac_sign, gender, delivery_time, timezone)
+            )
+
+    def set_timezone(self, chat_id, timezone):
+        """Часовой пояс чата: переживает сброс сессии и применяется к подписке"""
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO chat_timezones VALUES (?, ?)", (chat_id, timezone))
+            self._conn.execute("UPDATE subscribers SET timezone = ? WHERE chat_id = ?", (timezone, chat_id))
+
+    def timezone(self, chat_id):
+        """Часовой пояс чата или None, если пользователь его не указывал"""
+        with self._lock:
+            row = self._conn.execute("SELECT timezone FROM chat_timezones WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row[0] if row else None
+
+    def unsubscribe(self, chat_id):
+        """Отключение подписки. Возвращает True, если подписка была"""
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE subscribers SET active = 0 WHERE chat_id = ? AND active = 1", (chat_id,)
+            )
+        return cursor.rowcount > 0
+
+    def timezones(self):
+        """Часовые пояса активных подписчиков"""
+        with self._lock:
+            rows = self._conn.execute("SELECT DISTINCT timezone FROM subscribers WHERE active = 1").fetchall()
+        return [row[0] for row in rows]
+
+    def upcoming_pairs(self, timezone, after, until):
+        """Пары (знак, пол) подписчиков со временем доставки в (after, until]"""
+        with self._lock:
+            return self._conn.execute("""
+                SELECT DISTINCT zodiac_sign, gender FROM subscribers
+                WHERE active = 1 AND timezone = ? AND delivery_time > ? AND delivery_time <= ?
+            """, (timezone, after, until)).fetchall()
+
+    def claim_due(self, timezone, bucket, local_time):
+        """Подписчики, которым пора отправить рассылку за bucket.
+
+        Для них заводятся записи со статусом pending, поэтому после падения
+        процесса рассылка продолжится с недоставленных получателей.
+        """
+        with self._lock, self._conn:
+            self._conn.execute("""
+                INSERT OR IGNORE INTO deliveries (chat_id, bucket, status)
+                SELECT chat_id, ?, 'pending' FROM subscribers
+                WHERE active = 1 AND timezone = ? AND delivery_time <= ?
+            """, (bucket, timezone, local_time))
+            return self._conn.execute("""
+                SELECT s.chat_id, s.zodiac_sign, s.gender FROM deliveries d
+                JOIN subscribers s ON s.chat_id = d.chat_id
+                WHERE d.bucket = ? AND d.status = 'pending' AND s.active = 1 AND s.timezone = ?
+                ORDER BY s.zodiac_sign, s.gender
+            """, (bucket, timezone)).fetchall()
+
+    def mark(self, chat_id, bucket, status, error=None):
+        """Обновление статуса доставки"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE deliveries SET status = ?, error = ?, attempts = attempts + 1 WHERE chat_id = ? AND bucket = ?",
+                (status, error, chat_id, bucket)
+            )
+            if status == 'blocked':
+                self._conn.execute("UPDATE subscribers SET active = 0 WHERE chat_id = ?", (chat_id,))
+
+    def retry_later(self, chat_id, bucket, error):
+        """Неудачная попытка: оставляем pending или помечаем failed после лимита"""
+        with self._lock, self._conn:
+            self._conn.execute("""
+                UPDATE deliveries SET attempts = attempts + 1, error = ?,
+                    status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END
+                WHERE chat_id = ? AND bucket = ?
+            """, (error, BROADCAST_MAX_ATTEMPTS, chat_id, bucket))
+
+    def delivery_stats(self, bucket):
+        """Количество доставок по статусам"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*) FROM deliveries WHERE bucket = ? GROUP BY status", (bucket,)
+            ).fetchall()
+        return dict(rows)
+
+
+class BroadcastEngine:
+    """Ежедневная рассылка гороскопов подписчикам.
+
+    Контент генерируется один раз на пару (знак, пол) заранее, в фоновой
+    очереди за BROADCAST_PREGENERATE_AHEAD до времени доставки; получатели
+    обслуживаются из готовых частей сообщения без обращений к LLM. Если к
+    сроку контента нет (генерация не успела или LLM отказал), получатели
+    остаются pending до следующего прохода: резервный текст не рассылается.
+    Получатели обслуживаются в нескольких потоках, общая скорость отправки
+    ограничена глобальным token bucket.
+    """
+
+    def __init__(self, store, bot, rate_limit=BROADCAST_RATE_LIMIT, workers=BROADCAST_SEND_WORKERS):
+        self.store = store
+        self.bot = bot
+        self.rate_limiter = TokenBucket(rate_limit, BROADCAST_BURST)
+        self.workers = workers
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Запуск фонового цикла рассылки"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name='broadcast', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Остановка фонового цикла"""
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Broadcast failed: {str(e)}")
+            self._stop.wait(BROADCAST_CHECK_INTERVAL)
+
+    def run_once(self):
+        """Один проход: находим подписчиков, которым пора, и отправляем им гороскоп"""
+        for timezone in self.store.timezones():
+            local_now = calendar_service.now(timezone)
+            day = local_now.date()
+            bucket = calendar_service.bucket('today', day)
+            self._pregenerate(timezone, local_now)
+            recipients = self.store.claim_due(timezone, bucket, local_now.strftime('%H:%M'))
+
+            rendered = {}
+            deferred = 0
+            # Очередь к отправителям ограничена, чтобы не держать задачи на всех получателей
+            slots = threading.BoundedSemaphore(self.workers * 2)
+
+            def deliver(chat_id, parts):
+                try:
+                    self._deliver(chat_id, bucket, parts)
+                finally:
+                    slots.release()
+
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='broadcast-send') as senders:
+                for chat_id, zodiac_sign, gender in recipients:
+                    if self._stop.is_set():
+                        return
+                    if (zodiac_sign, gender) not in rendered:
+                        rendered[(zodiac_sign, gender)] = self._prepare(zodiac_sign, gender, day)
+                    if rendered[(zodiac_sign, gender)] is None:
+                        deferred += 1
+                        continue
+                    slots.acquire()
+                    senders.submit(deliver, chat_id, rendered[(zodiac_sign, gender)])
+
+            if deferred:
+                logger.info(f"Broadcast {bucket} {timezone}: {deferred} recipients wait for content")
+
+    def _pregenerate(self, timezone, local_now):
+        """Фоновая генерация для подписчиков, чье время доставки наступит в ближайшие минуты"""
+        ahead = local_now + timedelta(seconds=BROADCAST_PREGENERATE_AHEAD)
+        windows = [(local_now.date(), local_now.strftime('%H:%M'),
+                    ahead.strftime('%H:%M') if ahead.date() == local_now.date() else '23:59')]
+        if ahead.date() != local_now.date():
+            # Окно переходит через полночь: доставки завтрашнего дня
+            windows.append((ahead.date(), '', ahead.strftime('%H:%M')))
+
+        for day, after, until in windows:
+            for zodiac_sign, gender in self.store.upcoming_pairs(timezone, after, until):
+                content_key = horoscope_service.horoscope_key(zodiac_sign, 'today', gender, day)
+                if horoscope_service.content_cache.generation(content_key) is None:
+                    schedule_horoscope_generation(zodiac_sign, 'today', gender, day)
+
+    def _prepare(self, zodiac_sign, gender, day):
+        """Готовые части сообщения для пары (знак, пол) на локальную дату подписчика.
+
+        None, если сгенерированного контента еще нет: генерация ставится в
+        фоновую очередь, а получатели ждут следующего прохода.
+        """
+        content_key = horoscope_service.horoscope_key(zodiac_sign, 'today', gender, day)
+        parts = rendered_responses.get(content_key)
+        if parts is None:
+            # В кэше только настоящие ответы модели, резервный текст туда не попадает
+            result = horoscope_service.content_cache.get(content_key)
+            if result is None:
+                schedule_horoscope_generation(zodiac_sign, 'today', gender, day)
+                return None
+            parts = render_horoscope_parts(result, zodiac_sign, 'today', gender)
+            rendered_responses.put(content_key, parts)
+        return parts
+
+    def _deliver(self, chat_id, bucket, parts):
+        """Отправка одному подписчику с учетом лимитов Telegram"""
+        try:
+            for text, markup in parts:
+                while True:
+                    self.rate_limiter.acquire()
+                    try:
+                        self.bot.send_message(chat_id, text, reply_markup=markup, parse_mode='HTML')
+                        break
+                    except telebot.apihelper.ApiTelegramException as e:
+                        if e.error_code != 429:
+                            raise
+                        retry_after = e.result_json.get('parameters', {}).get('retry_after', 1)
+                        time.sleep(retry_after)
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code == 403 or 'chat not found' in e.description:
+                # Бот заблокирован, чат удален или недоступен
+                self.store.mark(chat_id, bucket, 'blocked', e.description)
+            else:
+                self.store.retry_later(chat_id, bucket, e.description)
+            return
+        except Exception as e:
+            self.store.retry_later(chat_id, bucket, str(e))
+            return
+
+        self.store.mark(chat_id, bucket, 'sent')
+
+
+subscription_store = TenantScoped('subscription_store')
+
+# Предзагрузка вероятной следующей генерации, пока пользователь выбирает
+PREFETCH_ENABLED = True
+# Сколько вариантов предзагружать за шаг и с какой минимальной вероятностью
+PREFETCH_MAX_CANDIDATES = 2
+PREFETCH_MIN_PROBABILITY = 0.3
+# Бюджет: предзагрузок в минуту и одновременно
+PREFETCH_PER_MINUTE = 30
+PREFETCH_MAX_INFLIGHT = 4
+# Предзагрузка запускается, только пока занято меньше этой доли мест LLM
+PREFETCH_ADMISSION_SHARE = 0.5
+# Начальные веса выборов, пока статистики мало: чаще всего выбирают "Сегодня"
+PREFETCH_PRIORS = {'period': {'today': 5}}
+
+
+class PrefetchPolicy:
+    """Предзагрузка самого вероятного следующего выбора пользователя.
+
+    Частоты выборов копятся на шагах диалога (период после знака, знак
+    партнера после своего знака). Когда пользователь доходит до шага,
+    вероятные варианты генерируются в фоне с PRIORITY_BACKGROUND, если
+    позволяют бюджет и свободные места в контроле допуска LLM. Запрос
+    пользователя присоединяется к идущей предзагрузке (см. _get_or_generate).
+    """
+
+    def __init__(self):
+        self._choices = {}
+        self._inflight = set()
+        self._lock = threading.Lock()
+        self._budget = TokenBucket(PREFETCH_PER_MINUTE / 60, PREFETCH_MAX_INFLIGHT)
+        self.started = 0
+        self.skipped = 0
+
+    def observe(self, step, context, choice):
+        """Учет выбора пользователя на шаге step"""
+        with self._lock:
+            self._choices.setdefault((step, context), Counter())[choice] += 1
+
+    def likely(self, step, context):
+        """Достаточно вероятные варианты шага, самые частые первыми"""
+        with self._lock:
+            counts = Counter(PREFETCH_PRIORS.get(step, {}))
+            counts.update(self._choices.get((step, context), {}))
+        total = sum(counts.values())
+        return [choice for choice, count in counts.most_common(PREFETCH_MAX_CANDIDATES)
+                if count / total >= PREFETCH_MIN_PROBABILITY]
+
+    def prefetch(self, content_key, generate):
+        """Фоновая генерация, если контента нет и бюджет позволяет"""
+        if not PREFETCH_ENABLED or horoscope_service.content_cache.generation(content_key) is not None:
+            return False
+
+        with self._lock:
+            if content_key in self._inflight:
+                return False
+            idle = (llm_admission.waiting == 0 and
+                    llm_admission.active < llm_admission.limit * PREFETCH_ADMISSION_SHARE)
+            if len(self._inflight) >= PREFETCH_MAX_INFLIGHT or not idle or not self._budget.try_acquire():
+                self.skipped += 1
+                return False
+            self._inflight.add(content_key)
+            self.started += 1
+
+        def run():
+            try:
+                generate()
+            finally:
+                with self._lock:
+                    self._inflight.discard(content_key)
+
+        background_executor.submit(logger.catch(run))
+        return True
+
+
+prefetch_policy = PrefetchPolicy()
+
+
+def prefetch_horoscope(zodiac_sign, gender, day):
+    """Шаг выбора периода: заранее генерируем самые вероятные периоды"""
+    for period in prefetch_policy.likely('period', None):
+        prefetch_policy.prefetch(
+            horoscope_service.horoscope_key(zodiac_sign, period, gender, day),
+            partial(horoscope_service.get_horoscope, zodiac_sign, period, gender,
+                    priority=PRIORITY_BACKGROUND, day=day)
+        )
+
+
+def prefetch_compatibility(first_sign, first_gender, second_gender):
+    """Шаг выбора знака партнера: заранее генерируем самые частые пары для этого знака"""
+    for second_sign in prefetch_policy.likely('second_zodiac', first_sign):
+        prefetch_policy.prefetch(
+            horoscope_service.compatibility_key(first_sign, first_gender, second_sign, second_gender),
+            partial(horoscope_service.get_compatibility, first_sign, first_gender, second_sign, second_gender,
+                    priority=PRIORITY_BACKGROUND)
+        )
+
+# Профилирование по запросу администратора
+PROFILE_OUTPUT_DIR = 'profiles'
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_MAX_SECONDS = 300
+PROFILE_SIGNAL_SECONDS = 30
+PROFILE_TRACEMALLOC_FRAMES = 25
+
+
+class SamplingProfiler:
+    """Сэмплирующий профилировщик работающего бота.
+
+    Пока профилирование выключено, ничего не запущено и обработчики не
+    платят ни за что. На время сеанса фоновый поток снимает стеки всех
+    потоков через sys._current_frames(), а tracemalloc считает выделения
+    памяти. Время и память приписываются обработчикам @bot.message_handler
+    и методам GPT5HoroscopeService.
+    """
+
+    def __init__(self, output_dir=PROFILE_OUTPUT_DIR, interval=PROFILE_SAMPLE_INTERVAL):
+        self.output_dir = output_dir
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, seconds, on_done=None):
+        """Запуск сеанса на seconds секунд. False, если сеанс уже идет"""
+        with self._lock:
+            if self._thread is not None:
+                return False
+            self._thread = threading.Thread(
+                target=self._run, args=(min(seconds, PROFILE_MAX_SECONDS), on_done),
+                name='profiler', daemon=True
+            )
+            self._thread.start()
+        return True
+
+    def _tracked_functions(self):
+        """Код отслеживаемых функций: code -> имя"""
+        functions = {}
+        for handler in bot.message_handlers + bot.inline_handlers:
+            function = inspect.unwrap(handler['function'])
+            functions[function.__code__] = function.__name__
+        for name, method in vars(GPT5HoroscopeService).items():
+            if inspect.isfunction(method):
+                functions[method.__code__] = f"GPT5HoroscopeService.{name}"
+        return functions
+
+    def _run(self, seconds, on_done):
+        tracked = self._tracked_functions()
+        own_tracemalloc = not tracemalloc.is_tracing()
+        if own_tracemalloc:
+            tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+        tracemalloc.reset_peak()
+
+        stacks = Counter()
+        attributed = Counter()
+        samples = 0
+        own_thread = threading.get_ident()
+        deadline = time.monotonic() + seconds
+
+        try:
+            while time.monotonic() < deadline:
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own_thread:
+                        continue
+                    names = []
+                    seen = set()
+                    while frame is not None:
+                        code = frame.f_code
+                        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                        if code in tracked and code not in seen:
+                            seen.add(code)
+                            attributed[tracked[code]] += 1
+                        frame = frame.f_back
+                    stacks[';'.join(reversed(names))] += 1
+                samples += 1
+                time.sleep(self.interval)
+
+            report = self._write_report(stacks, attributed, samples, tracked)
+        except Exception as e:
+            logger.error(f"Profiling failed: {str(e)}")
+            report = None
+        finally:
+            if own_tracemalloc:
+                tracemalloc.stop()
+            with self._lock:
+                self._thread = None
+
+        if on_done and report:
+            on_done(report)
+
+    def _write_report(self, stacks, attributed, samples, tracked):
+        """Сохраняет collapsed stacks, снимок памяти и сводку"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        base = os.path.join(self.output_dir, f"profile-{stamp}")
+
+        with open(base + '.folded', 'w', encoding='utf-8') as folded:
+            for stack, count in stacks.most_common():
+                folded.write(f"{stack} {count}\n")
+
+        allocations, snapshot_path = self._attribute_allocations(tracked, base)
+        _, peak = tracemalloc.get_traced_memory()
+
+        lines = [f"Samples: {samples}, interval: {self.interval * 1000:.1f} ms, peak memory: {peak / 1024:.0f} KiB"]
+        lines.append("Time (samples, % of samples):")
+        for name, count in attributed.most_common():
+            lines.append(f"  {name}: {count} ({count * 100 / max(samples, 1):.1f}%)")
+        lines.append("Allocated, still alive (KiB):")
+        for name, size in allocations.most_common():
+            lines.append(f"  {name}: {size / 1024:.1f}")
+        summary = '\n'.join(lines)
+
+        with open(base + '.txt', 'w', encoding='utf-8') as summary_file:
+            summary_file.write(summary + '\n')
+
+        return {'folded': base + '.folded', 'snapshot': snapshot_path, 'summary': summary}
+
+    def _attribute_allocations(self, tracked, base):
+        """Память, выделенная внутри отслеживаемых функций, и путь к снимку"""
+        snapshot = tracemalloc.take_snapshot()
+        snapshot_path = base + '.tracemalloc'
+        snapshot.dump(snapshot_path)
+
+        lines = {}
+        for code, name in tracked.items():
+            for _, _, lineno in code.co_lines():
+                if lineno is not None:
+                    lines[(code.co_filename, lineno)] = name
+
+        allocations = Counter()
+        for trace in snapshot.traces:
+            names = {lines[(frame.filename, frame.lineno)]
+                     for frame in trace.traceback if (frame.filename, frame.lineno) in lines}
+            for name in names:
+                allocations[name] += trace.size
+        return allocations, snapshot_path
+
+    def dump_allocations(self):
+        """Снимок памяти во время сеанса: (путь, пиковое потребление) или None"""
+        if not tracemalloc.is_tracing():
+            return None
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, f"allocations-{datetime.now().strftime('%Y%m%d-%H%M%S')}.tracemalloc")
+        tracemalloc.take_snapshot().dump(path)
+        return path, tracemalloc.get_traced_memory()[1]
+
+
+profiler = SamplingProfiler()
+
+
+# Имена, для которых значение заранее кладется в офлайн-пакет
+OFFLINE_PACK_NAMES = [
+    'Александр', 'Алексей', 'Андрей', 'Артем', 'Владимир', 'Дмитрий', 'Иван', 'Илья',
+    'Кирилл', 'Максим', 'Михаил', 'Никита', 'Николай', 'Павел', 'Роман', 'Сергей',
+    'Анастасия', 'Анна', 'Валерия', 'Виктория', 'Дарья', 'Екатерина', 'Елена', 'Ирина',
+    'Ксения', 'Мария', 'Наталья', 'Ольга', 'Полина', 'София', 'Татьяна', 'Юлия',
+]
+OFFLINE_PACK_BUILD_WORKERS = 4
+
+
+def build_offline_pack(path=OFFLINE_PACK_PATH):
+    """Генерирует офлайн-пакет: гороскопы, матрицу совместимости и популярные имена"""
+    genders = ['мужчина', 'женщина']
+    jobs = []
+    for sign in ZODIAC_SIGNS:
+        for period in ['today', 'tomorrow', 'week', 'month', 'year']:
+            for gender in genders:
+                jobs.append((('horoscope', sign, period, gender), 'horoscope',
+                             horoscope_service._generate_horoscope, (sign, period, gender)))
+        for partner_sign in ZODIAC_SIGNS:
+            for gender in genders:
+                # Бот подбирает партнеру противоположный пол
+                partner_gender = 'женщина' if gender == 'мужчина' else 'мужчина'
+                jobs.append((('compatibility', sign, gender, partner_sign, partner_gender), 'compatibility',
+                             horoscope_service._generate_compatibility, (sign, gender, partner_sign, partner_gender)))
+    for name in OFFLINE_PACK_NAMES:
+        jobs.append((('name', name.lower()), 'name_meaning', horoscope_service._generate_name_meaning, (name,)))
+
+    def run(job):
+        key_parts, field, generate, args = job
+        result = generate(*args)
+        if result.get('fallback') or result.get('incomplete'):
+            return None
+        return offline_pack_key(*key_parts), result[field]
+
+    entries = {}
+    with ThreadPoolExecutor(max_workers=OFFLINE_PACK_BUILD_WORKERS) as executor:
+        for entry in executor.map(run, jobs):
+            if entry:
+                entries[entry[0]] = entry[1]
+
+    if not entries:
+        # Пустой пакет не заменяет прежний: резервные тексты из него еще пригодятся
+        logger.error(f"Offline pack {path} not written: 0 of {len(jobs)} entries generated")
+        print(f"Офлайн-пакет {path}: 0 из {len(jobs)} записей, пакет не изменен")
+        return
+
+    # Словарь обучается на собранных текстах и используется и пакетом, и кэшами
+    codec = ContentCodec.train(list(entries.values()))
+    OfflineContentPack.write(path, entries, codec)
+    codec.save(CONTENT_DICT_PATH)
+
+    pack = OfflineContentPack(path)
+    pack._open()
+    if pack.codec is None:
+        print(f"Офлайн-пакет {path}: {len(entries)} из {len(jobs)} записей, но файл не читается")
+        return
+    for key in entries:
+        pack.get(key)
+    stats = pack.codec.stats()
+    print(f"Офлайн-пакет {path}: {len(entries)} из {len(jobs)} записей, "
+          f"{stats['codec']}: сжатие {stats['ratio']}x, распаковка {stats['decode_us']} мкс")
+
+
+def handle_profile_signal(signum, frame):
+    """SIGUSR1: профилирование на PROFILE_SIGNAL_SECONDS секунд"""
+    profiler.start(PROFILE_SIGNAL_SECONDS,
+                   on_done=lambda report: logger.info(f"Profile written to {report['folded']}"))
 
 @bot.message_handler(func=lambda message: any(period in message.text for period in [
     'Сегодня (', 'Завтра (', 'Неделя', 'Месяц (', 'Год ('
 ]))
 @logger.catch
+@traced_handler
 def handle_period_selection(message: telebot.types.Message) -> None:
     """Обработчик выбора периода для гороскопа"""
     chat_id = message.chat.id
@@ -889,10 +3651,17 @@ def handle_period_selection(message: telebot.types.Message) -> None:
                         reply_markup=get_zodiac_keyboard())
         return
 
-    zodiac_sign = user_data[chat_id]['zodiac_sign']
-    gender = user_data[chat_id]['gender']
+    with tracer.span('session_load'):
+        zodiac_sign = user_data[chat_id]['zodiac_sign']
+        gender = user_data[chat_id]['gender']
+        calendar_day = user_data[chat_id].get('calendar_day')
     period_text = message.text
 
+    # Ответ считается от даты, по которой построена клавиатура, если она не устарела
+    day = calendar_service.today(subscription_store.timezone(chat_id))
+    if calendar_day and (day - date.fromisoformat(calendar_day)).days <= 1:
+        day = date.fromisoformat(calendar_day)
+
     # Определяем период по тексту кнопки
     if period_text.startswith('Сегодня'):
         period = 'today'
@@ -908,63 +3677,12 @@ def handle_period_selection(message: telebot.types.Message) -> None:
         bot.send_message(chat_id, "Пожалуйста, выбери период из списка.")
         return
 
-    # Отправляем сообщение о загрузке
-    loading_msg = bot.send_message(chat_id, "🔮 <i>Составляю ваш персональный гороскоп... Это займет несколько секунд.</i>",
-                                  parse_mode='HTML')
-
-    # Получаем гороскоп
-    result = horoscope_service.get_horoscope(zodiac_sign, period, gender)
-
-    # Удаляем сообщение о загрузке
-    bot.delete_message(chat_id, loading_msg.message_id)
-
-    if result['success']:
-        zodiac_data = ZODIAC_SIGNS[zodiac_sign]
-
-        # Форматируем период для отображения
-        period_display = {
-            'today': 'Сегодня',
-            'tomorrow': 'Завтра',
-            'week': 'Неделя',
-            'month': 'Месяц',
-            'year': 'Год'
-        }.get(period, period)
-
-        gender_text = "мужчины" if gender == 'мужчина' else "женщины"
-
-        header = f"""
-{zodiac_data['emoji']} <b>ПЕРСОНАЛИЗИРОВАННЫЙ ГОРОСКОП ДЛЯ {gender_text.upper()}</b> {zodiac_data['emoji']}
-📅 <b>Период:</b> {period_display} ({result['period_dates']})
-👤 <b>Знак:</b> {zodiac_data['name']} | <b>Пол:</b> {gender}
-
-"""
-
-        footer = "\n\n✨ <i>Пусть звезды благоволят вам!</i>"
-
-        # Формируем полное сообщение
-        full_message = header + result['horoscope'] + footer
-
-        # Разделяем длинные сообщения
-        message_parts = split_long_message(full_message)
-
-        # Отправляем первую часть с клавиатурой, остальные - без
-        for i, part in enumerate(message_parts):
-            if i == 0:
-                # Первая часть с клавиатурой
-                bot.send_message(chat_id, part,
-                                reply_markup=get_main_menu_keyboard(),
-                                parse_mode='HTML')
-            else:
-                # Последующие части без клавиатуры
-                bot.send_message(chat_id, part,
-                                parse_mode='HTML')
-    else:
-        bot.send_message(chat_id,
-                        "❌ Извините, произошла ошибка при генерации гороскопа. Попробуйте позже.",
-                        reply_markup=get_main_menu_keyboard())
+    prefetch_policy.observe('period', None, period)
+    deliver_horoscope(chat_id, zodiac_sign, period, gender, day)
 
 @bot.message_handler(func=lambda message: message.text == '📜 Знаки зодиака')
 @logger.catch
+@traced_handler
 def zodiacs_command(message: telebot.types.Message) -> None:
     """Список знаков зодиака с датами"""
     zodiacs_text = "<b>Знаки зодиака и их периоды:</b>\n\n"
@@ -982,6 +3700,7 @@ def zodiacs_command(message: telebot.types.Message) -> None:
 @bot.message_handler(func=lambda message:
                     user_data.get(message.chat.id, {}).get('mode') == 'name_meaning')
 @logger.catch
+@traced_handler
 def handle_name_input(message: telebot.types.Message) -> None:
     """Обработчик ввода имени"""
     chat_id = message.chat.id
@@ -1008,42 +3727,296 @@ def handle_name_input(message: telebot.types.Message) -> None:
                         reply_markup=get_name_input_keyboard())
         return
 
-    # Отправляем сообщение о загрузке
-    loading_msg = bot.send_message(chat_id, f"📛 <i>Анализирую имя '{name}'... Это займет несколько секунд.</i>",
-                                   parse_mode='HTML')
+    if deliver_name_meaning(chat_id, name):
+        # Очищаем данные пользователя после успешного завершения
+        if chat_id in user_data:
+            del user_data[chat_id]
 
-    # Получаем значение имени
-    result = horoscope_service.get_name_meaning(name)
+# Inline-режим: @bot овен завтра
+INLINE_CACHE_TIME = 300
+INLINE_PENDING_CACHE_TIME = 5
 
-    # Удаляем сообщение о загрузке
-    bot.delete_message(chat_id, loading_msg.message_id)
+INLINE_PERIOD_WORDS = {
+    'сегодня': 'today', 'today': 'today',
+    'завтра': 'tomorrow', 'tomorrow': 'tomorrow',
+    'неделя': 'week', 'неделю': 'week', 'week': 'week',
+    'месяц': 'month', 'month': 'month',
+    'год': 'year', 'year': 'year',
+}
 
-    if result['success']:
-        header = f"📛 <b>ЗНАЧЕНИЕ ИМЕНИ: {name.upper()}</b>\n\n"
-        full_message = header + result['name_meaning']
+INLINE_GENDER_WORDS = {
+    'мужчина': 'мужчина', 'male': 'мужчина',
+    'женщина': 'женщина', 'female': 'женщина',
+}
 
-        # Разделяем длинные сообщения
-        message_parts = split_long_message(full_message)
+# Основы склоняемых названий знаков с беглой гласной: "овна", "тельцу", "льва", "стрельцом"
+INLINE_SIGN_ALIASES = {
+    'aries': ['овн'],
+    'taurus': ['тельц'],
+    'leo': ['льв'],
+    'sagittarius': ['стрельц'],
+}
 
-        # Отправляем части сообщения
-        for i, part in enumerate(message_parts):
-            if i == len(message_parts) - 1:
-                # Последняя часть с клавиатурой
-                bot.send_message(chat_id, part,
-                                 reply_markup=get_main_menu_keyboard(),
-                                 parse_mode='HTML')
-            else:
-                # Промежуточные части без клавиатуры
-                bot.send_message(chat_id, part,
-                                 parse_mode='HTML')
+# Падежные окончания, которые могут следовать за основой слова целиком
+INLINE_WORD_ENDINGS = ('а', 'я', 'у', 'ю', 'е', 'ы', 'и', 'ом', 'ем', 'ой', 'ей', 'ам', 'ям', 'ах', 'ях',
+                       'ами', 'ями', 'ов')
 
-        # Очищаем данные пользователя после успешного завершения
-        if chat_id in user_data:
-            del user_data[chat_id]
+def _inline_words():
+    """Слова запроса: (слово, тип, значение)"""
+    words = []
+    for sign_id, sign_data in ZODIAC_SIGNS.items():
+        words.append((sign_data['name'].lower(), 'sign', sign_id))
+        words.append((sign_id, 'sign', sign_id))
+        words.extend((alias, 'sign', sign_id) for alias in INLINE_SIGN_ALIASES.get(sign_id, []))
+    words.extend((word, 'period', period) for word, period in INLINE_PERIOD_WORDS.items())
+    words.extend((word, 'gender', gender) for word, gender in INLINE_GENDER_WORDS.items())
+    return words
+
+def _add_inline_key(index, key, kind, value):
+    if index.get(key, (kind, value)) != (kind, value):
+        # Неоднозначный ключ не распознаем
+        index[key] = None
     else:
+        index[key] = (kind, value)
+
+def _build_inline_index():
+    """Индекс префиксов слов запроса (слово еще набирается): префикс -> (тип, значение)"""
+    index = {}
+    for word, kind, value in _inline_words():
+        for length in range(3, len(word) + 1):
+            _add_inline_key(index, word[:length], kind, value)
+    return index
+
+def _build_inline_stems():
+    """Основы слов для падежных форм: слово целиком и без конечной гласной (весы -> вес)"""
+    stems = {}
+    for word, kind, value in _inline_words():
+        _add_inline_key(stems, word, kind, value)
+        if word[-1] in 'аяыиоеьй' and len(word) > 3:
+            _add_inline_key(stems, word[:-1], kind, value)
+    return stems
+
+_INLINE_INDEX = _build_inline_index()
+_INLINE_STEMS = _build_inline_stems()
+_INLINE_WORD_RE = re.compile(r'\w+')
+
+def _match_inline_word(word):
+    """Распознавание слова запроса: (тип, значение) или None.
+
+    Слово - начало известного слова или его основа целиком с падежным
+    окончанием ("близнецам", "рыбам"). Основа, за которой идет что-то
+    другое, не подходит: "весна" - не "весы".
+    """
+    match = _INLINE_INDEX.get(word)
+    if match is None:
+        for ending in INLINE_WORD_ENDINGS:
+            if word.endswith(ending) and len(word) > len(ending):
+                match = _INLINE_STEMS.get(word[:-len(ending)])
+                if match:
+                    break
+    return match
+
+def parse_inline_query(text):
+    """Разбор текста inline-запроса: (знак, период, пол)"""
+    found = {'sign': None, 'period': 'today', 'gender': None}
+    for word in _INLINE_WORD_RE.findall(text.lower()):
+        match = _match_inline_word(word)
+        if match:
+            found[match[0]] = match[1]
+    return found['sign'], found['period'], found['gender']
+
+@bot.inline_handler(func=lambda query: True)
+@logger.catch
+@traced_handler
+def handle_inline_query(query: telebot.types.InlineQuery) -> None:
+    """Ответ на inline-запрос только из кэша контента, без ожидания LLM"""
+    zodiac_sign, period, gender = parse_inline_query(query.query)
+
+    if not zodiac_sign:
+        hint = telebot.types.InlineQueryResultArticle(
+            'hint', '🔮 Напишите знак зодиака и период',
+            telebot.types.InputTextMessageContent(
+                "🔮 <b>AstroBot</b>\n\nНапишите, например: <i>овен завтра</i> или <i>рыбы неделя женщина</i>",
+                parse_mode='HTML'),
+            description='Например: овен завтра'
+        )
+        bot.answer_inline_query(query.id, [hint], cache_time=INLINE_CACHE_TIME)
+        return
+
+    zodiac_data = ZODIAC_SIGNS[zodiac_sign]
+    results = []
+    pending = False
+
+    for gender_option in ([gender] if gender else ['женщина', 'мужчина']):
+        content_key = horoscope_service.horoscope_key(zodiac_sign, period, gender_option)
+        result = horoscope_service.content_cache.get(content_key)
+        gender_text = "мужчины" if gender_option == 'мужчина' else "женщины"
+
+        if result is None:
+            pending = True
+            schedule_horoscope_generation(zodiac_sign, period, gender_option)
+            continue
+
+        message = format_horoscope_message(result, zodiac_sign, period, gender_option)
+        results.append(telebot.types.InlineQueryResultArticle(
+            f"{zodiac_sign}:{period}:{gender_option}",
+            f"{zodiac_data['emoji']} {zodiac_data['name']} - гороскоп для {gender_text}",
+            telebot.types.InputTextMessageContent(
+                next(iter_message_parts(message, TELEGRAM_MESSAGE_LIMIT)), parse_mode='HTML'),
+            description=f"{result['period_dates']}"
+        ))
+
+    if pending and not results:
+        results.append(telebot.types.InlineQueryResultArticle(
+            'pending', f"{zodiac_data['emoji']} Гороскоп готовится...",
+            telebot.types.InputTextMessageContent(
+                f"{zodiac_data['emoji']} Гороскоп для знака {zodiac_data['name']} готовится. "
+                f"Повторите запрос через несколько секунд."),
+            description='Повторите запрос через несколько секунд'
+        ))
+
+    bot.answer_inline_query(query.id, results,
+                            cache_time=INLINE_PENDING_CACHE_TIME if pending else INLINE_CACHE_TIME)
+
+@bot.message_handler(func=lambda message:
+                    user_data.get(message.chat.id, {}).get('step') == 'delivery_time')
+@logger.catch
+@traced_handler
+def handle_delivery_time_input(message: telebot.types.Message) -> None:
+    """Обработчик ввода времени рассылки"""
+    chat_id = message.chat.id
+
+    if message.text == '🔙 Назад':
+        back_command(message)
+        return
+
+    match = re.fullmatch(r'\s*(\d{1,2})[:.](\d{2})\s*', message.text or '')
+    if not match or int(match.group(1)) > 23 or int(match.group(2)) > 59:
+        bot.send_message(chat_id, "❌ Пожалуйста, введи время в формате ЧЧ:ММ, например 09:30.",
+                        reply_markup=get_delivery_time_keyboard())
+        return
+
+    delivery_time = f"{int(match.group(1)):02d}:{match.group(2)}"
+    user_data[chat_id].update({'delivery_time': delivery_time, 'step': 'timezone'})
+
+    bot.send_message(chat_id,
+                    f"✅ <b>Время: {delivery_time}</b>\n\n"
+                    f"🌍 <b>В каком ты часовом поясе?</b>\n"
+                    f"<i>Выбери город или введи пояс, например Asia/Almaty</i>",
+                    reply_markup=get_timezone_keyboard(),
+                    parse_mode='HTML')
+
+@bot.message_handler(func=lambda message:
+                    user_data.get(message.chat.id, {}).get('step') == 'timezone')
+@logger.catch
+@traced_handler
+def handle_timezone_input(message: telebot.types.Message) -> None:
+    """Обработчик выбора часового пояса (подписка и /timezone)"""
+    chat_id = message.chat.id
+
+    if message.text == '🔙 Назад':
+        back_command(message)
+        return
+
+    timezone = TIMEZONE_CHOICES.get(message.text)
+    if timezone is None:
+        try:
+            timezone = ZoneInfo((message.text or '').strip()).key
+        except (ValueError, ZoneInfoNotFoundError):
+            bot.send_message(chat_id, "❌ Не знаю такой часовой пояс. Выбери город из списка.",
+                            reply_markup=get_timezone_keyboard())
+            return
+
+    session = user_data.pop(chat_id)
+    subscription_store.set_timezone(chat_id, timezone)
+
+    if session['mode'] != 'subscribe':
         bot.send_message(chat_id,
-                         "❌ Извините, произошла ошибка при анализе имени. Попробуйте позже.",
-                         reply_markup=get_main_menu_keyboard())
+                        f"🌍 <b>Часовой пояс: {timezone}</b>\n\n"
+                        f"Сегодня у тебя {calendar_service.today(timezone).strftime('%d.%m')}, "
+                        f"гороскопы и рассылка считаются по этой дате.",
+                        reply_markup=get_main_menu_keyboard(),
+                        parse_mode='HTML')
+        return
+
+    subscription_store.subscribe(chat_id, session['zodiac_sign'], session['gender'],
+                                 session['delivery_time'], timezone)
+
+    zodiac_data = ZODIAC_SIGNS[session['zodiac_sign']]
+    bot.send_message(chat_id,
+                    f"🔔 <b>Подписка оформлена!</b>\n\n"
+                    f"Каждый день в {session['delivery_time']} ({timezone}) я буду присылать гороскоп "
+                    f"для знака {zodiac_data['emoji']} {zodiac_data['name']}.\n"
+                    f"Отключить: /unsubscribe",
+                    reply_markup=get_main_menu_keyboard(),
+                    parse_mode='HTML')
+
+@bot.message_handler(commands=['stats'], func=lambda message: message.from_user.id in ADMIN_IDS)
+@logger.catch
+@traced_handler
+def stats_command(message: telebot.types.Message) -> None:
+    """Администратор: счетчики запросов"""
+    with _request_counters_lock:
+        counters = dict(request_counters)
+
+    lines = [f"📊 <b>Счетчики запросов</b> ({current_tenant().name})"]
+    lines.extend(f"{name}: {value}" for name, value in sorted(counters.items()))
+    lines.append(f"sessions: {len(user_data)}, telegram_api_calls: {bot.api_calls}")
+    lines.append(f"llm_active: {llm_admission.active}/{llm_admission.limit}, llm_shed: {llm_admission.shed}")
+    lines.append(f"prefetch_started: {prefetch_policy.started}, prefetch_skipped: {prefetch_policy.skipped}")
+    with _validation_counters_lock:
+        validation = dict(validation_counters)
+    lines.append("llm_html: " + ', '.join(f"{name} {value}" for name, value in sorted(validation.items())))
+    quota = llm_quota.snapshot()
+    lines.append(f"llm_quota: requests {quota['requests'][0]}/{quota['requests'][1]}, "
+                 f"tokens {quota['tokens'][0]}/{quota['tokens'][1]}, throttled {llm_quota.throttled}, "
+                 f"rate_limited {llm_quota.rate_limited}, rejected {llm_quota.rejected}")
+    content_cache = horoscope_service.content_cache
+    lines.append(f"content_cache: {len(content_cache)} entries, "
+                 f"{content_cache.stored_bytes // 1024}/{content_cache.max_bytes // 1024} KB")
+    for store, codec in [('cache', content_codec), ('pack', offline_pack.codec)]:
+        if codec is not None:
+            codec_stats = codec.stats()
+            lines.append(f"{store}_codec: {codec_stats['codec']}, ratio {codec_stats['ratio']}x, "
+                         f"decode {codec_stats['decode_us']} µs")
+    if llm_journal.mode != 'off':
+        lines.append(f"llm_journal: {llm_journal.mode}, hits {llm_journal.hits}, misses {llm_journal.misses}")
+    if len(tenants) > 1:
+        lines.append(f"tenants: {', '.join(tenant.name for tenant in tenants)}")
+    bot.send_message(message.chat.id, '\n'.join(lines), parse_mode='HTML')
+
+@bot.message_handler(commands=['profile'], func=lambda message: message.from_user.id in ADMIN_IDS)
+@logger.catch
+@traced_handler
+def profile_command(message: telebot.types.Message) -> None:
+    """Администратор: /profile [секунды] - профилирование живого бота"""
+    chat_id = message.chat.id
+    args = message.text.split()
+    seconds = int(args[1]) if len(args) > 1 and args[1].isdigit() else PROFILE_SIGNAL_SECONDS
+    # Отчет приходит из потока профилировщика, где нет арендатора: отвечаем через бот, получивший команду
+    tenant = current_tenant()
+
+    def send_report(report):
+        tenant.bot.send_message(chat_id,
+                         f"📊 Профиль: {report['folded']}\nСнимок памяти: {report['snapshot']}\n\n{report['summary']}"[:TELEGRAM_MESSAGE_LIMIT])
+
+    if profiler.start(seconds, on_done=send_report):
+        bot.send_message(chat_id, f"📊 Профилирование запущено на {min(seconds, PROFILE_MAX_SECONDS)} с.")
+    else:
+        bot.send_message(chat_id, "📊 Профилирование уже идет.")
+
+@bot.message_handler(commands=['profile_mem'], func=lambda message: message.from_user.id in ADMIN_IDS)
+@logger.catch
+@traced_handler
+def profile_memory_command(message: telebot.types.Message) -> None:
+    """Администратор: снимок выделений памяти во время профилирования"""
+    dump = profiler.dump_allocations()
+    if dump is None:
+        bot.send_message(message.chat.id, "📊 Профилирование не запущено: /profile")
+        return
+
+    path, peak = dump
+    bot.send_message(message.chat.id, f"📊 Снимок памяти: {path}\nПик: {peak / 1024:.0f} KiB")
 
 def send_help_message(chat_id):
     """Общая функция для отправки справки"""
@@ -1069,8 +4042,14 @@ def send_help_message(chat_id):
 3. Для анализа имени - просто введи его
 4. Получи детальный анализ!
 
+<b>Inline-режим:</b>
+Напиши в любом чате <i>@имя_бота овен завтра</i> - гороскоп сразу из кэша
+
 <b>Команды:</b>
 /start - Главное меню
+/subscribe - Ежедневный гороскоп в удобное время
+/unsubscribe - Отключить рассылку
+/timezone - Часовой пояс
 /help - Эта справка
 """
     bot.send_message(chat_id, help_text,
@@ -1079,30 +4058,35 @@ def send_help_message(chat_id):
 
 @bot.message_handler(commands=['help'])
 @logger.catch
+@traced_handler
 def help_command(message: telebot.types.Message) -> None:
     """Обработчик команды /help"""
     send_help_message(message.chat.id)
 
 @bot.message_handler(func=lambda message: message.text == 'ℹ️ Помощь')
 @logger.catch
+@traced_handler
 def help_button(message: telebot.types.Message) -> None:
     """Обработчик кнопки помощи"""
     send_help_message(message.chat.id)
 
 @bot.message_handler(func=lambda message: message.text == '🔙 Назад')
 @logger.catch
+@traced_handler
 def back_command(message: telebot.types.Message) -> None:
     """Возврат в главное меню"""
     chat_id = message.chat.id
     if chat_id in user_data:
         del user_data[chat_id]
 
+    bot.forget_keyboard(chat_id)
     bot.send_message(chat_id, "🔙 <b>Возвращаемся в главное меню</b>",
                     reply_markup=get_main_menu_keyboard(),
                     parse_mode='HTML')
 
 @bot.message_handler(func=lambda message: True)
 @logger.catch
+@traced_handler
 def handle_other_messages(message: telebot.types.Message) -> None:
     """Обработчик всех остальных сообщений"""
     chat_id = message.chat.id
@@ -1110,6 +4094,601 @@ def handle_other_messages(message: telebot.types.Message) -> None:
                     "Я понимаю только команды и кнопки. Используй /start чтобы начать!",
                     reply_markup=get_main_menu_keyboard())
 
+# Запись входящего трафика (включается явно) и его воспроизведение
+UPDATE_RECORDING_PATH = None
+REPLAY_TELEGRAM_LATENCY = 0.05
+REPLAY_LLM_LATENCY = 8.0
+REPLAY_WORKERS = 2
+
+# Тексты кнопок и команд сохраняются в записи как есть, остальной текст обезличивается
+_RECORDABLE_TEXTS = {
+    '🔮 Получить гороскоп', '💑 Проверить совместимость', '📜 Знаки зодиака', '📛 Значение имени',
+    'ℹ️ Помощь', '👨 Мужчина', '👩 Женщина', '🔙 Назад', 'Неделя',
+} | {f"{sign_data['emoji']} {sign_data['name']}" for sign_data in ZODIAC_SIGNS.values()} | set(TIMEZONE_CHOICES)
+_RECORDABLE_RE = re.compile(r'(Сегодня|Завтра|Месяц|Год) \(.*\)|\d{1,2}[:.]\d{2}|/[a-z_]+')
+
+
+class UpdateRecorder:
+    """Запись обезличенных входящих апдейтов с таймингом в JSONL.
+
+    Идентификаторы пользователей и чатов заменяются HMAC с солью, которая
+    живет только в памяти процесса. Свободный текст (например, имена)
+    заменяется заглушкой той же длины, тексты кнопок и команды остаются.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._salt = secrets.token_bytes(16)
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def _anonymize_id(self, value):
+        digest = hmac.new(self._salt, str(value).encode(), hashlib.sha256).digest()
+        return int.from_bytes(digest[:4], 'big') + 1
+
+    def _anonymize_text(self, text):
+        if text is None or text in _RECORDABLE_TEXTS or _RECORDABLE_RE.fullmatch(text):
+            return text
+        return 'Имя' if len(text) <= 3 else 'Имя' + 'а' * (len(text) - 3)
+
+    def _anonymize(self, update):
+        """Обезличенный JSON апдейта, пригодный для Update.de_json"""
+        if update.message is not None:
+            message = update.message
+            user_id = self._anonymize_id(message.from_user.id)
+            chat_id = self._anonymize_id(message.chat.id)
+            return {
+                'update_id': update.update_id,
+                'message': {
+                    'message_id': message.message_id,
+                    'date': message.date,
+                    'chat': {'id': chat_id, 'type': message.chat.type},
+                    'from': {'id': user_id, 'is_bot': False, 'first_name': 'User'},
+                    'text': self._anonymize_text(message.text),
+                },
+            }
+        if update.inline_query is not None:
+            query = update.inline_query
+            words = [word for word in _INLINE_WORD_RE.findall(query.query.lower())
+                     if _match_inline_word(word)]
+            return {
+                'update_id': update.update_id,
+                'inline_query': {
+                    'id': str(self._anonymize_id(query.id)),
+                    'from': {'id': self._anonymize_id(query.from_user.id), 'is_bot': False, 'first_name': 'User'},
+                    'query': ' '.join(words),
+                    'offset': '',
+                },
+            }
+        return None
+
+    def record(self, updates, tenant_name):
+        """Добавление апдейтов бота tenant_name в запись"""
+        offset = round(time.monotonic() - self._started, 3)
+        lines = []
+        for update in updates:
+            anonymized = self._anonymize(update)
+            if anonymized is not None:
+                record = {'offset': offset, 'tenant': tenant_name, 'update': anonymized}
+                lines.append(json.dumps(record, ensure_ascii=False))
+        if lines:
+            with self._lock:
+                self._file.write('\n'.join(lines) + '\n')
+                self._file.flush()
+
+
+update_recorder = None
+
+
+class _StubResponse:
+    """Ответ-заглушка в форме requests.Response"""
+
+    def __init__(self, payload, status_code=200, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self._payload = payload
+        self.text = json.dumps(payload, ensure_ascii=False)
+
+    def json(self):
+        return self._payload
+
+
+class _StubBotApi:
+    """Заглушка Bot API для воспроизведения (apihelper.CUSTOM_REQUEST_SENDER)"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        # Моменты отправки sendMessage для проверки лимита скорости
+        self.sent_at = []
+        self._message_ids = iter(range(1, 1 << 62))
+        self._lock = threading.Lock()
+
+    def __call__(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        api_method = url.rsplit('/', 1)[-1]
+        if api_method == 'sendMessage':
+            with self._lock:
+                self.sent_at.append(time.monotonic())
+        time.sleep(self.latency)
+        params = params or {}
+        if api_method in ('sendMessage', 'editMessageText'):
+            with self._lock:
+                message_id = next(self._message_ids)
+            result = {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+        else:
+            result = True
+        return _StubResponse({'ok': True, 'result': result})
+
+
+def _stub_llm_content(kind, markdown=False):
+    """Ответ-образец со всеми разделами вида kind (markdown - с типичными ошибками модели)"""
+    paragraph = 'Звезды советуют действовать спокойно и последовательно. ' * 12
+    if markdown:
+        # Заголовки через раз в стиле "## **РАЗДЕЛ**", в тексте одиночные ** и __
+        return '\n\n'.join(
+            f"{'## **' if i % 2 else '**'}{title}**\n{paragraph}<3 & * пункт ** сноска, __ и **важно**"
+            for i, title in enumerate(EXPECTED_SECTIONS[kind])
+        )
+    return '\n\n'.join(f"<b>{title}</b>\n{paragraph}" for title in EXPECTED_SECTIONS[kind])
+
+
+class _StubLLMSession:
+    """Заглушка PROXY API: ответ со всеми разделами запрошенного вида с заданной задержкой"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+
+    def post(self, url, headers=None, json=None, timeout=None):
+        self.calls += 1
+        prompt = json['messages'][-1]['content']
+        kind = next((kind for kind, sections in EXPECTED_SECTIONS.items() if sections[0] in prompt), 'horoscope')
+        time.sleep(self.latency)
+        return _StubResponse({'choices': [{'message': {'content': _stub_llm_content(kind)}}]})
+
+
+def _update_label(update):
+    """Категория апдейта для отчета о задержках"""
+    if update.inline_query is not None:
+        return 'inline_query'
+    text = update.message.text or ''
+    if text.startswith('/'):
+        return text.split()[0]
+    match = _RECORDABLE_RE.fullmatch(text)
+    if match and match.group(1):
+        return 'period'
+    if any(sign_data['name'] in text for sign_data in ZODIAC_SIGNS.values()):
+        return 'zodiac'
+    if text in _RECORDABLE_TEXTS:
+        return text
+    return 'text'
+
+
+def _latency_summary(values):
+    """p50/p90/p99/max задержек в миллисекундах"""
+    ordered = sorted(values)
+    if len(ordered) > 1:
+        cuts = statistics.quantiles(ordered, n=100, method='inclusive')
+        p50, p90, p99 = cuts[49], cuts[89], cuts[98]
+    else:
+        p50 = p90 = p99 = ordered[0]
+    return {
+        'count': len(ordered),
+        'p50_ms': round(p50 * 1000, 1),
+        'p90_ms': round(p90 * 1000, 1),
+        'p99_ms': round(p99 * 1000, 1),
+        'max_ms': round(ordered[-1] * 1000, 1),
+    }
+
+
+def replay_updates(path, speed=None, llm_latency=REPLAY_LLM_LATENCY,
+                   telegram_latency=REPLAY_TELEGRAM_LATENCY, workers=REPLAY_WORKERS,
+                   llm_journal_path=None, llm_latency_scale=LLM_JOURNAL_LATENCY_SCALE):
+    """Воспроизводит запись через обработчики против заглушек Bot API и LLM.
+
+    speed: множитель скорости (1, 10, ...) или None - без пауз. С журналом
+    LLM ответы модели берутся из него, а календарь фиксируется на дату
+    записи журнала. Возвращает отчет о задержках обработки по категориям
+    апдейтов.
+    """
+    global llm_journal
+
+    with open(path, encoding='utf-8') as recording:
+        records = [json.loads(line) for line in recording if line.strip()]
+
+    # Изолируем воспроизведение от внешних систем и боевых файлов
+    telebot.apihelper.CUSTOM_REQUEST_SENDER = _StubBotApi(telegram_latency)
+    llm_stub = _StubLLMSession(llm_latency)
+    horoscope_service.api_key = horoscope_service.api_key or 'replay'
+    horoscope_service._session = llm_stub
+    if llm_journal_path:
+        llm_journal = LLMJournal(llm_journal_path, 'replay', llm_latency_scale)
+        calendar_service.frozen_day = llm_journal.recorded_day()
+    tracer.enabled = False
+    for tenant in tenants:
+        tenant.subscription_store = Lazy(partial(SubscriptionStore, ':memory:'))
+        tenant.bot.threaded = False
+
+    latencies = {}
+    api_calls_before = sum(tenant.bot.api_calls for tenant in tenants)
+    started = time.monotonic()
+
+    def process(tenant, update, scheduled):
+        tenant.bot.process_new_updates([update])
+        latencies.setdefault(_update_label(update), []).append(time.monotonic() - scheduled)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for record in records:
+            scheduled = started + record['offset'] / speed if speed else time.monotonic()
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            update = telebot.types.Update.de_json(record['update'])
+            tenant = tenants_by_name.get(record.get('tenant'), tenants[0])
+            executor.submit(process, tenant, update, scheduled)
+
+    report = {
+        'updates': len(records),
+        'speed': speed or 'max',
+        'duration_s': round(time.monotonic() - started, 2),
+        'llm_calls': llm_stub.calls + llm_journal.hits + llm_journal.misses,
+        'llm_journal_misses': llm_journal.misses,
+        'telegram_calls': sum(tenant.bot.api_calls for tenant in tenants) - api_calls_before,
+        'overall': _latency_summary([value for values in latencies.values() for value in values]) if records else {},
+        'by_label': {label: _latency_summary(values) for label, values in sorted(latencies.items())},
+    }
+    return report
+
+
+def benchmark_html_validation(rounds=2000):
+    """Скорость проверки ответов модели: мкс на ответ для чистого и испорченного HTML"""
+    report = {}
+    for kind in EXPECTED_SECTIONS:
+        for markdown in (False, True):
+            sample = _stub_llm_content(kind, markdown)
+            started = time.perf_counter()
+            for _ in range(rounds):
+                validate_llm_content(kind, sample)
+            elapsed = time.perf_counter() - started
+            report[f"{kind}{'_markdown' if markdown else ''}"] = {
+                'bytes': len(sample.encode('utf-8')),
+                'us_per_response': round(elapsed / rounds * 1e6, 1),
+                'mb_per_s': round(len(sample.encode('utf-8')) * rounds / elapsed / 1e6, 1),
+                'verdict': validate_llm_content(kind, sample)[1],
+            }
+    return report
+
+
+# Лимиты частей для замера разбиения: реальный и уменьшенные, чтобы чаще резать
+SPLIT_BENCH_LIMITS = (4000, 1024, 512)
+
+
+def benchmark_message_split(rounds=200):
+    """Скорость разбиения образцовых ответов модели (свойства разбиения проверяют тесты)"""
+    report = {}
+    for kind in EXPECTED_SECTIONS:
+        # Три ответа подряд - заведомо длиннее лимита Telegram
+        sample = '\n\n'.join([_stub_llm_content(kind)] * 3)
+        units = utf16_len(sample)
+        for max_length in SPLIT_BENCH_LIMITS:
+            started = time.perf_counter()
+            for _ in range(rounds):
+                parts = list(iter_message_parts(sample, max_length))
+            elapsed = time.perf_counter() - started
+            report[f"{kind}_{max_length}"] = {
+                'utf16_units': units,
+                'parts': len(parts),
+                'us_per_split': round(elapsed / rounds * 1e6, 1),
+                'm_units_per_s': round(units * rounds / elapsed / 1e6, 1),
+            }
+    return report
+
+
+# Бенчмарк рассылки: все подписчики без ограничения скорости и выборка с боевым лимитом
+BROADCAST_BENCH_SUBSCRIBERS = 100000
+BROADCAST_BENCH_RATE_SAMPLE = 500
+BROADCAST_BENCH_UNLIMITED_RATE = 10 ** 9
+
+
+def _seeded_subscription_store(subscribers):
+    """Хранилище в памяти с подписчиками, которым рассылка уже положена"""
+    store = SubscriptionStore(':memory:')
+    signs = list(ZODIAC_SIGNS)
+    rows = (
+        (chat_id, signs[chat_id % len(signs)], ('мужчина', 'женщина')[chat_id // len(signs) % 2],
+         '00:00', DEFAULT_TIMEZONE, 1)
+        for chat_id in range(1, subscribers + 1)
+    )
+    with store._lock, store._conn:
+        store._conn.executemany("INSERT INTO subscribers VALUES (?, ?, ?, ?, ?, ?)", rows)
+    return store
+
+
+def _rate_overrun(timestamps, rate, capacity):
+    """Наибольшее превышение token bucket: на сколько отправок какое-либо окно
+    [t_i, t_j] превысило capacity + rate * (t_j - t_i). Не больше 0 - лимит соблюден"""
+    worst = float('-inf')
+    lowest = float('inf')
+    for index, sent_at in enumerate(timestamps):
+        level = index - rate * sent_at
+        lowest = min(lowest, level)
+        worst = max(worst, level - lowest + 1)
+    return worst - capacity
+
+
+def _peak_per_second(timestamps):
+    """Наибольшее число отправок за любую секунду"""
+    peak = 0
+    start = 0
+    for index, sent_at in enumerate(timestamps):
+        while sent_at - timestamps[start] >= 1:
+            start += 1
+        peak = max(peak, index - start + 1)
+    return peak
+
+
+def benchmark_broadcast(subscribers=BROADCAST_BENCH_SUBSCRIBERS, rate_sample=BROADCAST_BENCH_RATE_SAMPLE,
+                        telegram_latency=REPLAY_TELEGRAM_LATENCY):
+    """Рассылка BroadcastEngine.run_once против заглушек Bot API и LLM.
+
+    Сначала все подписчики без ограничения скорости - запас пропускной
+    способности движка, затем выборка с BROADCAST_RATE_LIMIT - проверка,
+    что token bucket держит лимит Telegram.
+    """
+    bot_api = _StubBotApi(telegram_latency)
+    telebot.apihelper.CUSTOM_REQUEST_SENDER = bot_api
+    llm_stub = _StubLLMSession(0)
+    horoscope_service.api_key = horoscope_service.api_key or 'bench'
+    horoscope_service._session = llm_stub
+    tracer.enabled = False
+    bucket = calendar_service.bucket('today', calendar_service.now(DEFAULT_TIMEZONE).date())
+
+    report = {'telegram_latency_s': telegram_latency, 'rate_limit': BROADCAST_RATE_LIMIT}
+    phases = (('unthrottled', subscribers, BROADCAST_BENCH_UNLIMITED_RATE),
+              ('rate_limited', rate_sample, BROADCAST_RATE_LIMIT))
+    for phase, count, rate in phases:
+        store = _seeded_subscription_store(count)
+        engine = BroadcastEngine(store, tenants[0].bot, rate_limit=rate)
+        bot_api.sent_at.clear()
+        started = time.monotonic()
+        # Первый проход ставит генерацию в фон, второй рассылает готовый контент
+        engine.run_once()
+        while _scheduled_generations:
+            time.sleep(0.01)
+        engine.run_once()
+        elapsed = time.monotonic() - started
+        sent_at = sorted(bot_api.sent_at)
+        report[phase] = {
+            'subscribers': count,
+            'messages': len(sent_at),
+            'duration_s': round(elapsed, 2),
+            'subscribers_per_s': round(count / elapsed, 1),
+            'messages_per_s': round(len(sent_at) / elapsed, 1),
+            'peak_messages_per_s': _peak_per_second(sent_at),
+            'deliveries': store.delivery_stats(bucket),
+        }
+    report['rate_limited']['bucket_holds'] = _rate_overrun(
+        sorted(bot_api.sent_at), BROADCAST_RATE_LIMIT, BROADCAST_BURST) <= 0
+    # LLM вызывается на пару (знак, пол), а не на получателя
+    report['llm_calls'] = llm_stub.calls
+    # Полная рассылка упирается в лимит Telegram, если запас движка больше 1
+    report['full_run_at_limit_s'] = round(report['unthrottled']['messages'] / BROADCAST_RATE_LIMIT)
+    report['engine_headroom'] = round(report['unthrottled']['messages_per_s'] / BROADCAST_RATE_LIMIT, 1)
+    return report
+
+
+def compare_replay_reports(baseline, current):
+    """Строки сравнения двух отчетов воспроизведения по p50/p99"""
+    lines = []
+    for label in sorted(set(baseline['by_label']) | set(current['by_label'])):
+        before = baseline['by_label'].get(label)
+        after = current['by_label'].get(label)
+        if not before or not after:
+            lines.append(f"{label}: только в {'текущем' if after else 'базовом'} отчете")
+            continue
+        deltas = []
+        for metric in ('p50_ms', 'p99_ms'):
+            change = (after[metric] - before[metric]) / before[metric] * 100 if before[metric] else 0.0
+            deltas.append(f"{metric} {before[metric]} -> {after[metric]} ({change:+.1f}%)")
+        lines.append(f"{label}: " + ', '.join(deltas))
+    return lines
+
+
+# Жизненный цикл: запуск, готовность и плавная остановка
+SESSIONS_SNAPSHOT_PATH = 'sessions.json'
+JOBS_SNAPSHOT_PATH = 'inflight_jobs.json'
+READY_FILE_PATH = 'astro_bot.ready'
+# Сколько ждать завершения генераций при остановке, прежде чем сохранить их
+SHUTDOWN_GRACE_PERIOD = 20
+
+ready_event = threading.Event()
+
+
+def _load_snapshot(path):
+    """Чтение и удаление снимка состояния"""
+    try:
+        with open(path, encoding='utf-8') as snapshot_file:
+            data = json.load(snapshot_file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.error(f"Snapshot {path} is unreadable: {str(e)}")
+        return None
+    os.remove(path)
+    return data
+
+
+def _save_snapshot(path, data):
+    """Атомарная запись снимка состояния"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as snapshot_file:
+        json.dump(data, snapshot_file, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def restore_state(tenant):
+    """Восстановление сессий и незавершенных генераций бота после перезапуска"""
+    sessions = _load_snapshot(tenant.path(SESSIONS_SNAPSHOT_PATH)) or {}
+    tenant.user_data.update({int(chat_id): session for chat_id, session in sessions.items()})
+
+    jobs = _load_snapshot(tenant.path(JOBS_SNAPSHOT_PATH)) or []
+    for job in jobs:
+        deliverer = JOB_DELIVERERS.get(job['kind'])
+        if deliverer:
+            background_executor.submit(tenant.run, logger.catch(deliverer), job['chat_id'], *job['args'])
+
+    return len(sessions), len(jobs)
+
+
+def startup(recording_path=UPDATE_RECORDING_PATH):
+    """Запуск: логирование, восстановление состояния, фоновые задачи, готовность"""
+    global update_recorder
+
+    setup_logging()
+    setup_telegram_session()
+    if recording_path:
+        update_recorder = UpdateRecorder(recording_path)
+
+    signal.signal(signal.SIGTERM, handle_shutdown_signal)
+    signal.signal(signal.SIGINT, handle_shutdown_signal)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, handle_profile_signal)
+
+    sessions_count = jobs_count = 0
+    for tenant in tenants:
+        restored_sessions, restored_jobs = restore_state(tenant)
+        sessions_count += restored_sessions
+        jobs_count += restored_jobs
+        tenant.broadcast_engine.start()
+
+    with open(READY_FILE_PATH, 'w') as ready_file:
+        ready_file.write(str(os.getpid()))
+    ready_event.set()
+
+    startup_ms = (time.perf_counter() - STARTUP_STARTED) * 1000
+    logger.info(f"Ready in {startup_ms:.0f} ms: restored {sessions_count} sessions, resumed {jobs_count} jobs")
+    print(f"Бот готов за {startup_ms:.0f} мс (сессий: {sessions_count}, генераций: {jobs_count})")
+
+
+def handle_shutdown_signal(signum, frame):
+    """SIGTERM/SIGINT: прекращаем прием апдейтов, остановка завершится в shutdown()"""
+    ready_event.clear()
+    for tenant in tenants:
+        tenant.bot.stop_polling()
+
+
+def shutdown():
+    """Плавная остановка: ждем генерации, сохраняем незавершенные и сессии"""
+    ready_event.clear()
+    if os.path.exists(READY_FILE_PATH):
+        os.remove(READY_FILE_PATH)
+
+    for tenant in tenants:
+        tenant.broadcast_engine.stop()
+
+    deadline = time.monotonic() + SHUTDOWN_GRACE_PERIOD
+    for tenant in tenants:
+        if not tenant.inflight_jobs.wait_idle(max(deadline - time.monotonic(), 0)):
+            pending_jobs = tenant.inflight_jobs.snapshot()
+            _save_snapshot(tenant.path(JOBS_SNAPSHOT_PATH), pending_jobs)
+            logger.info(f"Persisted {len(pending_jobs)} in-flight jobs of {tenant.name}")
+
+        sessions = {str(chat_id): session for chat_id, session in tenant.user_data.items()}
+        _save_snapshot(tenant.path(SESSIONS_SNAPSHOT_PATH), sessions)
+    tracer.flush()
+
+
+def parse_args():
+    """Аргументы командной строки"""
+    parser = argparse.ArgumentParser(description='Astro_bot')
+    parser.add_argument('--record', metavar='PATH', default=UPDATE_RECORDING_PATH,
+                        help='записывать обезличенные входящие апдейты в JSONL')
+    parser.add_argument('--llm-journal', choices=LLMJournal.MODES, default=LLM_JOURNAL_MODE,
+                        help='записывать ответы LLM в журнал или отвечать из него')
+    parser.add_argument('--llm-journal-path', default=LLM_JOURNAL_PATH)
+    parser.add_argument('--llm-latency-scale', type=float, default=LLM_JOURNAL_LATENCY_SCALE,
+                        help='множитель записанных задержек LLM при воспроизведении')
+    commands = parser.add_subparsers(dest='command')
+
+    build_pack = commands.add_parser('build-pack', help='сгенерировать офлайн-пакет контента')
+    build_pack.add_argument('path', nargs='?', default=OFFLINE_PACK_PATH)
+
+    replay = commands.add_parser('replay', help='воспроизвести запись трафика против заглушек')
+    replay.add_argument('recording')
+    replay.add_argument('--speed', default='1', help='множитель скорости (1, 10, ...) или max')
+    replay.add_argument('--llm-latency', type=float, default=REPLAY_LLM_LATENCY)
+    # Свой dest: иначе путь перезаписал бы режим журнала из общего --llm-journal
+    replay.add_argument('--llm-journal-path', dest='replay_journal_path', metavar='PATH',
+                        help='отвечать за LLM из журнала ответов')
+    # Тот же параметр, что и у основного парсера: без значения остается общий
+    replay.add_argument('--llm-latency-scale', type=float, default=argparse.SUPPRESS,
+                        help='множитель записанных задержек LLM из журнала')
+    replay.add_argument('--report', metavar='PATH', help='сохранить отчет в JSON')
+    replay.add_argument('--compare', metavar='PATH', help='сравнить с отчетом другой сборки')
+
+    bench_html = commands.add_parser('bench-html', help='замер скорости проверки HTML ответов модели')
+    bench_html.add_argument('--rounds', type=int, default=2000)
+
+    bench_broadcast = commands.add_parser('bench-broadcast', help='замер рассылки по заглушке Bot API')
+    bench_broadcast.add_argument('--subscribers', type=int, default=BROADCAST_BENCH_SUBSCRIBERS)
+    bench_broadcast.add_argument('--rate-sample', type=int, default=BROADCAST_BENCH_RATE_SAMPLE)
+    bench_broadcast.add_argument('--telegram-latency', type=float, default=REPLAY_TELEGRAM_LATENCY)
+
+    bench_split = commands.add_parser('bench-split', help='замер скорости разбиения длинных сообщений')
+    bench_split.add_argument('--rounds', type=int, default=200)
+    return parser.parse_args()
+
+
+def run_replay(args):
+    """Команда replay: воспроизведение, отчет и сравнение"""
+    speed = None if args.speed == 'max' else float(args.speed)
+    report = replay_updates(args.recording, speed=speed, llm_latency=args.llm_latency,
+                            llm_journal_path=args.replay_journal_path, llm_latency_scale=args.llm_latency_scale)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+    if args.report:
+        _save_snapshot(args.report, report)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+        print('\n'.join(compare_replay_reports(baseline, report)))
+
+
 if __name__ == "__main__":
+    args = parse_args()
+    if args.command != 'replay':
+        llm_journal = LLMJournal(args.llm_journal_path, args.llm_journal, args.llm_latency_scale)
+        if llm_journal.mode == 'replay':
+            # Промпты зависят от даты: без фиксации на следующий день все запросы промахнутся
+            calendar_service.frozen_day = llm_journal.recorded_day()
+    if args.command == 'build-pack':
+        build_offline_pack(args.path)
+        sys.exit(0)
+    if args.command == 'replay':
+        run_replay(args)
+        sys.exit(0)
+    if args.command == 'bench-html':
+        print(json.dumps(benchmark_html_validation(args.rounds), ensure_ascii=False, indent=2))
+        sys.exit(0)
+    if args.command == 'bench-broadcast':
+        report = benchmark_broadcast(args.subscribers, args.rate_sample, args.telegram_latency)
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        sys.exit(0 if report['rate_limited']['bucket_holds'] else 1)
+    if args.command == 'bench-split':
+        print(json.dumps(benchmark_message_split(args.rounds), ensure_ascii=False, indent=2))
+        sys.exit(0)
+
+    startup(args.record)
     print("Бот Astro_bot запущен с обновленной логикой и использованием GPT-5!")
-    bot.infinity_polling()
\ No newline at end of file
+    # Дополнительные боты опрашиваются в своих потоках, основной - в главном
+    for tenant in tenants[1:]:
+        threading.Thread(target=tenant.bot.infinity_polling, name=f'polling-{tenant.name}', daemon=True).start()
+    try:
+        tenants[0].bot.infinity_polling()
+    finally:
+        shutdown()
\ No newline at end of file
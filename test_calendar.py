@@ -0,0 +1,48 @@
+"""
+Календарь периодов гороскопа: границы, корзины кэша и подписи.
+"""
+
+from datetime import date
+
+import pytest
+
+from astro_bot_test import CalendarService
+
+
+@pytest.fixture
+def calendar():
+    return CalendarService('Europe/Moscow')
+
+
+@pytest.mark.parametrize('period, day, bounds, bucket, label', [
+    ('today', date(2026, 10, 19), (date(2026, 10, 19), date(2026, 10, 19)), '2026-10-19', '19 октябрь'),
+    ('tomorrow', date(2026, 10, 31), (date(2026, 11, 1), date(2026, 11, 1)), '2026-11-01', '1 ноябрь'),
+    ('week', date(2026, 10, 21), (date(2026, 10, 19), date(2026, 10, 25)), '2026-W43', '19.10 - 25.10'),
+    ('month', date(2028, 2, 10), (date(2028, 2, 1), date(2028, 2, 29)), '2028-02', 'февраль'),
+    ('year', date(2026, 10, 19), (date(2026, 1, 1), date(2026, 12, 31)), '2026', '2026'),
+])
+def test_period(calendar, period, day, bounds, bucket, label):
+    assert calendar.bounds(period, day) == bounds
+    assert calendar.bucket(period, day) == bucket
+    assert calendar.label(period, day) == label
+
+
+def test_week_across_new_year_is_one_bucket(calendar):
+    # ISO-неделя с 28.12.2026 по 03.01.2027 принадлежит 2026 году
+    assert calendar.bucket('week', date(2026, 12, 31)) == calendar.bucket('week', date(2027, 1, 1)) == '2026-W53'
+    assert calendar.label('week', date(2027, 1, 3)) == '28.12 - 03.01'
+    assert calendar.bucket('tomorrow', date(2026, 12, 31)) == '2027-01-01'
+
+
+def test_buckets_change_with_the_day(calendar):
+    monday, sunday = date(2026, 10, 19), date(2026, 10, 25)
+    assert calendar.bucket('week', monday) == calendar.bucket('week', sunday)
+    assert calendar.bucket('today', monday) != calendar.bucket('today', sunday)
+    assert calendar.bucket('tomorrow', monday) == calendar.bucket('today', date(2026, 10, 20))
+
+
+def test_today_uses_timezone_and_frozen_day(calendar):
+    assert calendar.now('Asia/Kamchatka').utcoffset() != calendar.now('Europe/Kaliningrad').utcoffset()
+    calendar.frozen_day = date(2026, 1, 15)
+    assert calendar.today('Asia/Kamchatka') == date(2026, 1, 15)
+    assert calendar.bucket('month') == '2026-01'
@@ -0,0 +1,90 @@
+"""
+Сжатие контента, офлайн-пакет и кэш сгенерированного контента.
+"""
+
+import time
+
+import pytest
+
+from astro_bot_test import (EXPECTED_SECTIONS, ContentCache, ContentCodec, OfflineContentPack,
+                            RenderedResponseCache, _stub_llm_content, offline_pack_key)
+
+SAMPLES = [f"{_stub_llm_content(kind)}\n{number}" for kind in EXPECTED_SECTIONS for number in range(20)]
+
+
+@pytest.fixture(params=['plain', 'trained'])
+def codec(request):
+    if request.param == 'trained':
+        return ContentCodec.train(SAMPLES)
+    return ContentCodec(b'', ContentCodec.ZLIB)
+
+
+def test_codec_round_trip(codec):
+    for text in SAMPLES + ['', 'ascii only', '🌟 эмодзи и &amp; сущности']:
+        assert codec.decompress(codec.compress(text)) == text
+
+
+def test_trained_dictionary_improves_ratio():
+    plain = ContentCodec(b'', ContentCodec.ZLIB)
+    trained = ContentCodec.train(SAMPLES)
+    for text in SAMPLES:
+        plain.compress(text)
+        trained.compress(text)
+    assert trained.stored_bytes < plain.stored_bytes
+
+
+def test_codec_save_and_load(tmp_path):
+    codec = ContentCodec.train(SAMPLES)
+    path = str(tmp_path / 'content.dict')
+    codec.save(path)
+    loaded = ContentCodec.load(path)
+    assert (loaded.name, loaded.dictionary) == (codec.name, codec.dictionary)
+    assert loaded.decompress(codec.compress(SAMPLES[0])) == SAMPLES[0]
+
+
+def test_pack_round_trip(tmp_path):
+    entries = {offline_pack_key('horoscope', str(number)): text for number, text in enumerate(SAMPLES)}
+    path = str(tmp_path / 'content.pack')
+    OfflineContentPack.write(path, entries, ContentCodec.train(SAMPLES))
+
+    pack = OfflineContentPack(path)
+    for key, text in entries.items():
+        assert pack.get(key) == text
+    assert pack.get(offline_pack_key('horoscope', 'missing')) is None
+    assert pack.codec.stats()['ratio'] > 1
+
+
+def test_missing_pack_returns_none(tmp_path):
+    pack = OfflineContentPack(str(tmp_path / 'missing.pack'))
+    assert pack.get(offline_pack_key('horoscope', 'aries')) is None
+    assert pack.codec is None
+
+
+def test_cache_bounded_by_stored_bytes():
+    cache = ContentCache(max_bytes=4096, codec=ContentCodec(b'', ContentCodec.ZLIB))
+    for number, text in enumerate(SAMPLES):
+        cache.put(number, {'text': text})
+    assert cache.stored_bytes <= cache.max_bytes
+    assert cache.get(len(SAMPLES) - 1) == {'text': SAMPLES[-1]}
+    assert cache.get(0) is None
+
+
+def test_rendered_cache_follows_content_cache():
+    cache = ContentCache(ttl=0.5, max_bytes=4096, codec=ContentCodec(b'', ContentCodec.ZLIB))
+    rendered = RenderedResponseCache(cache)
+    for number, text in enumerate(SAMPLES):
+        cache.put(number, {'text': text})
+        rendered.put(number, [['часть', None]])
+    # Вытесненные из кэша контента записи уходят и отсюда
+    assert len(rendered._entries) == len(cache)
+
+    last = len(SAMPLES) - 1
+    assert rendered.get(last) == (('часть', None),)
+    cache.put(last, {'text': 'новый ответ'})
+    assert rendered.get(last) is None
+
+    rendered.put(last, [['часть', None]])
+    time.sleep(0.6)
+    # Истекшая запись сбрасывает и отрисованные части
+    assert cache.get(last) is None
+    assert last not in rendered._entries
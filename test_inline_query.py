@@ -0,0 +1,49 @@
+"""
+Разбор текста inline-запроса: знак, период и пол.
+"""
+
+import pytest
+
+from astro_bot_test import parse_inline_query
+
+
+@pytest.mark.parametrize('query, expected', [
+    ('овен', ('aries', 'today', None)),
+    ('Овен завтра', ('aries', 'tomorrow', None)),
+    ('рыбы неделя женщина', ('pisces', 'week', 'женщина')),
+    ('leo month male', ('leo', 'month', 'мужчина')),
+    ('гороскоп на год для скорпиона', ('scorpio', 'year', None)),
+    # Начало слова, которое еще набирается
+    ('близ', ('gemini', 'today', None)),
+    ('козе нед', ('capricorn', 'week', None)),
+])
+def test_query_is_parsed(query, expected):
+    assert parse_inline_query(query) == expected
+
+
+@pytest.mark.parametrize('query, sign', [
+    ('овна', 'aries'),
+    ('тельцу', 'taurus'),
+    ('тельца', 'taurus'),
+    ('близнецам', 'gemini'),
+    ('раку', 'cancer'),
+    ('льва', 'leo'),
+    ('деве', 'virgo'),
+    ('весам', 'libra'),
+    ('скорпиону', 'scorpio'),
+    ('стрельцом', 'sagittarius'),
+    ('козерогу', 'capricorn'),
+    ('водолея', 'aquarius'),
+    ('рыбам', 'pisces'),
+])
+def test_declined_sign_names(query, sign):
+    assert parse_inline_query(query)[0] == sign
+
+
+@pytest.mark.parametrize('query', ['весна', 'левый', 'раковина', 'рыбалка', 'девочка', 'привет'])
+def test_other_words_are_not_signs(query):
+    assert parse_inline_query(query) == (None, 'today', None)
+
+
+def test_declined_period_and_gender():
+    assert parse_inline_query('раку на неделю мужчине') == ('cancer', 'week', 'мужчина')
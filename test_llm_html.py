@@ -0,0 +1,72 @@
+"""
+Исправление HTML из ответов модели перед отправкой в Telegram.
+"""
+
+import pytest
+
+from astro_bot_test import EXPECTED_SECTIONS, _stub_llm_content, sanitize_llm_html
+
+
+@pytest.mark.parametrize('raw, expected', [
+    ('## **ОБЩИЙ ПРОГНОЗ**\nтекст', '<b>ОБЩИЙ ПРОГНОЗ</b>\nтекст'),
+    ('# Здоровье\nтекст', '<b>Здоровье</b>\nтекст'),
+    ('**важно** и **очень**', '<b>важно</b> и <b>очень</b>'),
+    ('<h2>Карьера</h2>', '<b>Карьера</b>'),
+    ('* пункт\n- еще пункт', '• пункт\n• еще пункт'),
+    ('a<br>b', 'a\nb'),
+    ('<b>жирный <i>курсив</b> дальше</i>', '<b>жирный <i>курсив</i></b><i> дальше</i>'),
+    ('<b>не закрыт', '<b>не закрыт</b>'),
+    ('лишний </i> тег', 'лишний  тег'),
+    ('<b class="x">жирный</b>', '<b>жирный</b>'),
+])
+def test_markup_is_repaired(raw, expected):
+    text, repairs = sanitize_llm_html(raw)
+    assert text == expected
+    assert repairs > 0
+
+
+@pytest.mark.parametrize('raw, expected', [
+    # Одиночные маркеры жирного - обычный текст
+    ('2 ** 3 и сноска**', '2 ** 3 и сноска**'),
+    ('snake__case', 'snake__case'),
+    # Жирный не переходит на следующую строку
+    ('**начало\nконец**', '**начало\nконец**'),
+])
+def test_stray_markers_stay_literal(raw, expected):
+    assert sanitize_llm_html(raw)[0] == expected
+
+
+def test_special_characters_are_escaped():
+    text, _ = sanitize_llm_html('<3 & 5 < 6, но &amp; и &#128153; остаются')
+    assert text == '&lt;3 &amp; 5 &lt; 6, но &amp; и &#128153; остаются'
+
+
+@pytest.mark.parametrize('raw, expected', [
+    ('<a href="https://t.me/astro?x=1&amp;y=2">бот</a>', '<a href="https://t.me/astro?x=1&amp;y=2">бот</a>'),
+    ("<A HREF='tg://user?id=1' target=_blank>профиль</A>", '<a href="tg://user?id=1">профиль</a>'),
+    ('<a href="javascript:alert(1)">ссылка</a>', 'ссылка'),
+    ('<a>без адреса</a>', 'без адреса'),
+    ('<span class="tg-spoiler">тайна</span>', '<span class="tg-spoiler">тайна</span>'),
+    ('<span style="color: red">текст</span>', 'текст'),
+    ('<tg-spoiler>тайна</tg-spoiler>', '<tg-spoiler>тайна</tg-spoiler>'),
+])
+def test_attributes_are_whitelisted(raw, expected):
+    assert sanitize_llm_html(raw)[0] == expected
+
+
+def test_reopened_link_keeps_href():
+    text, _ = sanitize_llm_html('<b><a href="https://t.me/astro">a</b>b</a>')
+    assert text == '<b><a href="https://t.me/astro">a</a></b><a href="https://t.me/astro">b</a>'
+
+
+def test_markdown_inside_code_is_literal():
+    raw = '<pre>**x** = 1\n# комментарий\n- пункт</pre>\n<code>a**b**c</code> и **жирный**'
+    text, _ = sanitize_llm_html(raw)
+    assert text == '<pre>**x** = 1\n# комментарий\n- пункт</pre>\n<code>a**b**c</code> и <b>жирный</b>'
+
+
+@pytest.mark.parametrize('kind', sorted(EXPECTED_SECTIONS))
+def test_sanitized_text_is_stable(kind):
+    text, repairs = sanitize_llm_html(_stub_llm_content(kind, markdown=True))
+    assert repairs > 0
+    assert sanitize_llm_html(text) == (text, 0)
@@ -0,0 +1,120 @@
+"""
+Квота провайдера и контроль допуска к LLM.
+"""
+
+import threading
+import time
+
+import pytest
+import requests
+import urllib3
+
+from astro_bot_test import (PRIORITY_BACKGROUND, PRIORITY_USER, AdmissionController, AdmissionRejected,
+                            QuotaScheduler, request_never_sent)
+
+WAIT_TIMEOUT = 5
+
+
+def wait_until(condition):
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    while not condition():
+        assert time.monotonic() < deadline, 'condition not reached'
+        time.sleep(0.005)
+
+
+def connection_error(reason):
+    return requests.exceptions.ConnectionError(urllib3.exceptions.MaxRetryError(None, '/', reason))
+
+
+@pytest.mark.parametrize('error, never_sent', [
+    (requests.exceptions.ConnectTimeout('connect'), True),
+    (connection_error(urllib3.exceptions.NewConnectionError(None, 'refused')), True),
+    (requests.exceptions.ReadTimeout('read'), False),
+    (connection_error(urllib3.exceptions.ProtocolError('connection reset')), False),
+])
+def test_request_never_sent(error, never_sent):
+    assert request_never_sent(error) is never_sent
+
+
+def test_quota_refunded_when_request_not_sent():
+    quota = QuotaScheduler(rpm=10, tpm=10000)
+    with pytest.raises(AdmissionRejected):
+        with quota.reserve(100):
+            raise AdmissionRejected('LLM queue is full')
+    assert quota.snapshot() == {'requests': (10, 10), 'tokens': (10000, 10000)}
+
+
+def test_quota_kept_when_request_sent():
+    quota = QuotaScheduler(rpm=10, tpm=10000)
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        with quota.reserve(100) as reservation:
+            reservation['sent'] = True
+            raise requests.exceptions.ReadTimeout('read')
+    assert quota.snapshot() == {'requests': (9, 10), 'tokens': (9900, 10000)}
+
+
+def test_quota_exhausted_rejects_after_timeout():
+    quota = QuotaScheduler(rpm=1, tpm=10000)
+    with quota.reserve(100) as reservation:
+        reservation['sent'] = True
+    with pytest.raises(AdmissionRejected):
+        with quota.reserve(100, PRIORITY_BACKGROUND, timeout=0.05):
+            pass
+    assert quota.rejected == 1
+
+
+class Waiter(threading.Thread):
+    """Запрос места в отдельном потоке: результат admitted или rejected"""
+
+    def __init__(self, controller, priority):
+        super().__init__(daemon=True)
+        self.controller = controller
+        self.priority = priority
+        self.result = None
+        self.release = threading.Event()
+
+    def run(self):
+        try:
+            with self.controller.admit(self.priority, timeout=WAIT_TIMEOUT):
+                self.result = 'admitted'
+                self.release.wait(WAIT_TIMEOUT)
+        except AdmissionRejected:
+            self.result = 'rejected'
+
+
+def test_admission_sheds_background_first():
+    controller = AdmissionController(limit=1, max_queue=2)
+    with controller.admit(PRIORITY_USER):
+        background = Waiter(controller, PRIORITY_BACKGROUND)
+        background.start()
+        wait_until(lambda: controller.waiting == 1)
+
+        # Фоновые задачи занимают не больше половины очереди
+        with pytest.raises(AdmissionRejected):
+            with controller.admit(PRIORITY_BACKGROUND):
+                pass
+
+        users = [Waiter(controller, PRIORITY_USER) for _ in range(2)]
+        users[0].start()
+        wait_until(lambda: controller.waiting == 2)
+        # Очередь полна: пользовательский запрос вытесняет фоновый
+        users[1].start()
+        wait_until(lambda: background.result == 'rejected')
+        assert controller.waiting == 2
+
+    for user in users:
+        wait_until(lambda: user.result == 'admitted')
+        user.release.set()
+        user.join(WAIT_TIMEOUT)
+    assert controller.shed == 2
+    assert controller.active == 0
+
+
+def test_admission_wait_times_out():
+    controller = AdmissionController(limit=1, max_queue=2)
+    with controller.admit():
+        with pytest.raises(AdmissionRejected, match='timed out'):
+            with controller.admit(timeout=0.05):
+                pass
+    assert controller.waiting == 0
+    assert controller.shed == 1
@@ -0,0 +1,113 @@
+"""
+Свойства разбиения длинных сообщений на случайных ответах в стиле модели.
+"""
+
+import random
+import re
+
+import pytest
+
+from astro_bot_test import EXPECTED_SECTIONS, iter_message_parts, utf16_len
+
+TAG_RE = re.compile(r'<(/?)([a-zA-Z]+)[^<>]*>')
+VISIBLE_TEXT_RE = re.compile(r'<[^<>]*>|\s+')
+BROKEN_ENTITY_RE = re.compile(r'&(?![a-zA-Z]+;|#[0-9]+;)')
+WORDS = ('звезды', 'советуют', 'действовать', 'спокойно', 'Марс', 'Венера',
+         'гармония', 'energy', '🌟', '💫', '&amp;', '&lt;3')
+CASES = 500
+
+
+def random_llm_text(rng):
+    """Случайный ответ в стиле модели: разделы с <b>-заголовками, вложенные теги,
+    эмодзи, сущности, абзацы одной строкой и очень длинные слова"""
+    titles = [title for sections in EXPECTED_SECTIONS.values() for title in sections]
+    sections = []
+    for _ in range(rng.randint(1, 8)):
+        paragraphs = []
+        for _ in range(rng.randint(1, 4)):
+            sentences = []
+            for _ in range(rng.randint(1, 15)):
+                sentence = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 20)))
+                wrap = rng.random()
+                if wrap < 0.1:
+                    sentence = f'<i>{sentence}</i>'
+                elif wrap < 0.15:
+                    sentence = f'<a href="https://t.me/astro_bot">{sentence}</a>'
+                elif wrap < 0.2:
+                    sentence = f'<u><b>{sentence}</b></u>'
+                sentences.append(sentence + '.')
+            # Модель иногда пишет абзац одной строкой без переносов
+            paragraph = (' ' if rng.random() < 0.3 else '\n').join(sentences)
+            if rng.random() < 0.1:
+                paragraph = f'<i>{paragraph}</i>'
+            paragraphs.append(paragraph)
+        if rng.random() < 0.05:
+            paragraphs.append(rng.choice(('🌟', '💫')) * rng.randint(1000, 5000))
+        sections.append(f"<b>{rng.choice(titles)}</b>\n" + '\n\n'.join(paragraphs))
+    return '\n\n'.join(sections)
+
+
+def generated_cases(seed=2026):
+    """Случайные тексты и лимиты длины части"""
+    rng = random.Random(seed)
+    for _ in range(CASES):
+        yield random_llm_text(rng), rng.choice((4000, 1024, 512))
+
+
+@pytest.fixture(scope='module')
+def split_cases():
+    return [(text, max_length, list(iter_message_parts(text, max_length)))
+            for text, max_length in generated_cases()]
+
+
+def test_parts_fit_telegram_limit(split_cases):
+    for text, max_length, parts in split_cases:
+        assert all(utf16_len(part) <= max_length for part in parts)
+
+
+def test_tags_balanced_in_every_part(split_cases):
+    for text, max_length, parts in split_cases:
+        for part in parts:
+            stack = []
+            tags = list(TAG_RE.finditer(part))
+            # Ни один тег не разрезан пополам
+            assert part.count('<') == len(tags)
+            for match in tags:
+                closing, name = match.group(1), match.group(2).lower()
+                if closing:
+                    assert stack and stack.pop() == name, part
+                else:
+                    stack.append(name)
+            assert not stack, part
+
+
+def test_entities_are_not_cut(split_cases):
+    for text, max_length, parts in split_cases:
+        for part in parts:
+            assert not BROKEN_ENTITY_RE.search(VISIBLE_TEXT_RE.sub('', part)), part
+
+
+def test_no_text_lost(split_cases):
+    for text, max_length, parts in split_cases:
+        assert VISIBLE_TEXT_RE.sub('', ''.join(parts)) == VISIBLE_TEXT_RE.sub('', text)
+
+
+def test_utf16_length_counts_surrogate_pairs():
+    assert utf16_len('🌟') == 2
+    assert utf16_len('звезды') == 6
+    parts = list(iter_message_parts('🌟' * 3000, 4000))
+    assert len(parts) == 2
+    assert all(utf16_len(part) <= 4000 for part in parts)
+
+
+def test_short_text_is_single_part():
+    text = '<b>ОБЩИЙ ПРОГНОЗ</b>\nЗвезды советуют действовать спокойно.'
+    assert list(iter_message_parts(text)) == [text]
+
+
+def test_cut_prefers_section_header():
+    section = 'Звезды советуют действовать спокойно и последовательно.\n' * 45
+    text = f"<b>ОБЩИЙ ПРОГНОЗ</b>\n{section}\n<b>ЗДОРОВЬЕ</b>\n{section}"
+    parts = list(iter_message_parts(text, 4000))
+    assert len(parts) == 2
+    assert parts[1].lstrip().startswith('<b>ЗДОРОВЬЕ</b>')